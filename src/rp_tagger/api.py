@@ -1,59 +1,114 @@
-import shutil
+import base64
+import binascii
 from datetime import datetime
 import sqlalchemy.exc
 from sqlalchemy import (
     desc,
-    create_engine,
+    insert,
     update,
     func,
     select,
     column,
     text,
+    inspect,
+    tuple_,
+    bindparam,
 )
-from sqlalchemy.orm import sessionmaker, aliased
+from sqlalchemy.orm import sessionmaker, scoped_session, aliased
 from sqlalchemy.orm.query import Query
 import json
 import logging
 
+from itertools import islice
+
 # the project is too unstable atm to make type hints
 # from typing import Union, List, Set, Tuple, Dict
 import os
-from glob import glob
+import re
+from collections import Counter
+from typing import NamedTuple
 from pathlib import Path
 
 from rp_tagger.conf import settings
 
-from rp_tagger.db import Tag, Image, tag_relationship
+from rp_tagger.db import Tag, Image, tag_relationship, tag_fts, make_engine
+from rp_tagger.index import tag_index
+from rp_tagger.cache import query_cache
 from rp_tagger.log import logged
+from rp_tagger.scan import walk_images
 
 _ENGINE = settings.DATABASES["default"]["engine"]
-ENGINE = create_engine(_ENGINE)
+ENGINE = make_engine(_ENGINE)
 CONFIG = settings.DATABASES["default"]["config"]
 
 log = logging.getLogger("global")
 
+# max number of bound parameters in an IN (...)
+IN_LIMIT = 500
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    return iter(lambda: list(islice(iterator, size)), [])
+
 
 def load_images(path=settings.IMAGES_FROM_DIR):
     """Loads images from the selected folder recursively and tries to guess
     the tags from the name"""
-    images = []
-    for ext in settings.ACCEPT:
-        new_images = glob(str(path) + f"/**/{ext}", recursive=True)
-
-        # we try to guess the tags from the folders
-        for image in new_images:
-            tags = list(
-                set((Path(image).parent.parts)).difference(set(Path(path).parts))
-            )
-            images.append({"path": image, "tags": tags})
-        log.info(f"Fetched %d %s files", len(new_images), ext)
+    images = list(walk_images(path))
     log.info(f"Fetched a total of %d files", len(images))
     return images
 
 
+def encode_cursor(hits, id):
+    """Opaque position in the (hits, id) ordering of the images"""
+    return base64.urlsafe_b64encode(f"{hits}:{id}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Raises ValueError if the cursor is not valid"""
+    try:
+        hits, id = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        return int(hits), int(id)
+    except (TypeError, UnicodeError, binascii.Error) as exc:
+        raise ValueError(f"Invalid cursor {cursor!r}") from exc
+
+
+def like_pattern(name):
+    """LIKE '%name%' with the % and _ of `name` taken literally. ESCAPE '\\'"""
+    return "%" + re.sub(r"([\\%_])", r"\\\1", name) + "%"
+
+
+def match_tags(name, fts=True):
+    """
+    Select of the ids of the tags that contain `name`, ignoring the case of
+    the ASCII letters only as LIKE does (same as TagIndex.match). The
+    trigram index only helps with names of 3 or more characters, anything
+    shorter is a plain scan.
+    """
+    like = Tag.name.like(like_pattern(name), escape="\\")
+    if not fts or len(name) < 3:
+        return select(Tag.id).where(like)
+
+    # the trigram tokenizer folds the case of every letter, LIKE has the last word
+    query = '"' + name.replace('"', '""') + '"'
+    candidates = select(tag_fts.c.rowid).where(tag_fts.c.name.match(query))
+    return select(Tag.id).where(Tag.id.in_(candidates)).where(like)
+
+
+class ImageRecord(NamedTuple):
+    """What the templates need from an image. `tags` are the names"""
+
+    id: int
+    name: str
+    path: str
+    hits: int
+    tags: tuple = ()
+
+
 @logged
 class DBClient:
-    def __init__(self, engine=ENGINE, config=CONFIG):
+    def __init__(self, engine=ENGINE, config=CONFIG, index=tag_index, hits=None, cache=query_cache):
         config = config or {}
         self.logger.debug("Started %s. Engine: %s", self.__class__.__name__, ENGINE)
 
@@ -61,66 +116,153 @@ class DBClient:
         assert db_file.exists(), "DB file doesn't exist!"
         assert db_file.stat().st_size > 0, "DB file is just an empty file!"
 
-        Session = sessionmaker(bind=engine, **config)
-        self.session = Session()
+        # one session per thread. `remove` ends the unit of work
+        self.Session = scoped_session(sessionmaker(bind=engine, **config))
+        self.fts = inspect(engine).has_table("tag_fts")
+
+        self.index = index
+        if index is not None and not index.loaded:
+            index.load(self.session)
+        # HitBuffer. Without it the hits are written right away
+        self.hits = hits
+        # QueryCache of the views, emptied by the writes
+        self.cache = cache
 
-        self.already_queried = []
+    @property
+    def session(self):
+        return self.Session()
+
+    def remove(self):
+        """Closes the session of the current thread"""
+        self.Session.remove()
 
     def __delete__(self):
-        self.session.close()
+        self.Session.remove()
+
+    def cached(self, key, func):
+        """The cached result of `func`, see QueryCache"""
+        if self.cache is None:
+            return func()
+        return self.cache.get_or_set(key, func)
 
-    def dump_unclassified(self, images):
+    def invalidate(self):
+        """The images or the tags changed"""
+        if self.cache is not None:
+            self.cache.invalidate()
 
+    def dump_unclassified(self, images, batch_size=settings.BULK_BATCH_SIZE):
+        """
+        Bulk insert of the images and their tags. Everything happens in one
+        transaction with one executemany per table and batch. Returns the
+        ids of the images, in order.
+        """
+        added = []
+        with self.session.begin():
+            for batch in chunked(images, batch_size):
+                added.extend(self._dump_batch(batch))
+
+        if self.index is not None:
+            for image_id, tags in added:
+                self.index.add(image_id, tags)
+        self.invalidate()
+        return [image_id for image_id, _ in added]
+
+    def _dump_batch(self, images):
+        # (image_id, tag_id) is the primary key of the association
+        images = [dict(image, tags=list(dict.fromkeys(image["tags"]))) for image in images]
+
+        rows = []
+        now = datetime.now()
         for image in images:
             path = image["path"]
             assert isinstance(path, str), "The path must be a string"
+            rows.append(
+                {
+                    "name": image["name"],
+                    "path": path,
+                    "size": image.get("size"),
+                    "quick_hash": image.get("quick_hash"),
+                    "content_hash": image.get("content_hash"),
+                    "phash": image.get("phash"),
+                    "tag_count": len(image["tags"]),
+                    # restored from a dump, see rp_tagger.backup
+                    "hits": image.get("hits") or 0,
+                    "last_used": image.get("last_used"),
+                    "date_created": image.get("date_created") or now,
+                }
+            )
+        self.session.execute(insert(Image), rows)
+        tag_ids = self.resolve_tags({tag for image in images for tag in image["tags"]})
 
-            tags = [self.add_tag(tag) for tag in image["tags"]]
-            name = image["name"]
+        image_ids = {}
+        for names in chunked([row["name"] for row in rows], IN_LIMIT):
+            image_ids.update(
+                self.session.query(Image.name, Image.id).filter(Image.name.in_(names))
+            )
 
-            img = Image(name=name, path=path, tags=tags)
-            self.session.add(img)
+        assoc = [
+            {"image_id": image_ids[image["name"]], "tag_id": tag_ids[tag]}
+            for image in images
+            for tag in image["tags"]
+        ]
+        if assoc:
+            self.session.execute(insert(tag_relationship), assoc)
+            self._add_usage([row["tag_id"] for row in assoc], 1)
 
-    def load_images(self, offset=0, limit=200):
-        return self.session.query(Image).offset(offset).limit(limit).all()
+        return [(image_ids[image["name"]], image["tags"]) for image in images]
 
-    def load_less_tagged_images(self):
+    def resolve_tags(self, names):
         """
-        SELECT * from image ORDER BY (SELECT COUNT(image_id) from assoc_tagged_image WHERE image.id = image_id) LIMIT 200;
+        Maps tag names to ids, creating the missing tags. Call it in the
+        transaction that uses the ids, after its first write: SQLite holds
+        the write lock by then and no other client can add or delete them.
         """
-        count_matches = (
-            select(func.count(tag_relationship._columns.image_id))
-            .where(Image.id == tag_relationship._columns.image_id)
-            .scalar_subquery()
-        )
-        result = (
-            self.session.query(Image)
-            .where(count_matches < 1)
+        tag_ids = self._load_tag_ids(set(names))
+        new = [name for name in set(names) if name not in tag_ids]
+        if new:
+            self.session.execute(insert(Tag), [{"name": name} for name in new])
+            tag_ids.update(self._load_tag_ids(new))
+        return tag_ids
+
+    def _load_tag_ids(self, names):
+        tag_ids = {}
+        for chunk in chunked(names, IN_LIMIT):
+            tag_ids.update(self.session.query(Tag.name, Tag.id).filter(Tag.name.in_(chunk)))
+        return tag_ids
+
+    def load_images(self, offset=0, limit=200):
+        return self.session.query(Image).offset(offset).limit(limit).all()
+
+    def untagged_query(self, *columns):
+        """Untagged images the tagger can read"""
+        return (
+            select(*columns or (Image,))
+            .where(Image.tag_count < 1)
             .where(~Image.name.like("%.gif"))
             .where(~Image.name.like("%.webm"))
             .where(~Image.name.like("%.webp"))
-            .order_by(count_matches)
-            .limit(200)
-            .all()
         )
-        return result
 
-    def load_less_tagged(self):
+    def load_less_tagged_images(self, limit=200, after_id=0, until_id=None):
         """
-        SELECT * from image ORDER BY (SELECT COUNT(image_id) from assoc_tagged_image WHERE image.id = image_id) LIMIT 200;
+        Untagged images the tagger can read. `after_id` is the id of the last
+        image of the previous call, the ones the model had nothing for are
+        still untagged. `until_id` is the last id included.
         """
-        count_matches = (
-            select(func.count(tag_relationship._columns.image_id))
-            .where(Image.id == tag_relationship._columns.image_id)
-            .scalar_subquery()
-        )
+        query = self.untagged_query().where(Image.id > after_id)
+        if until_id is not None:
+            query = query.where(Image.id <= until_id)
+        return self.session.execute(query.order_by(Image.id).limit(limit)).scalars().all()
+
+    def load_less_tagged(self):
+        """SELECT * from image WHERE tag_count < 1 ORDER BY tag_count LIMIT 200;"""
         result = (
             self.session.query(Image)
-            .where(count_matches < 1)
-            .order_by(count_matches)
+            .where(Image.tag_count < 1)
+            .order_by(Image.tag_count)
             .limit(200)
             .all()
-        )  # .where(count_matches < 5).all()
+        )  # .where(Image.tag_count < 5).all()
         return result
 
     def count_unclassified(self):
@@ -133,8 +275,27 @@ class DBClient:
     def count_images(self):
         return self.session.query(func.count(Image.id)).one()[0]
 
-    def get_paginated_result(self, start, size, tags=None):
-        """Gets a slice of the DB images. Images[start:end]"""
+    def get_paginated_result(self, size, tags=None, cursor=None, touch=True):
+        """
+        Gets the next `size` images after `cursor`, most hits first. Returns
+        the images and the cursor of the next page (None if it was the last
+        one). With `touch` the searched tags get a hit.
+        """
+        after = decode_cursor(cursor) if cursor else None
+
+        if touch:
+            for tag in tags or ():
+                self.touch_tag(tag)
+        if tags and self.index is not None:
+            images = self.get_images(self.index.search(tags, after=after, limit=size))
+        else:
+            images = self._paginated_query(size, tags, after).all()
+
+        if len(images) < size:
+            return images, None
+        return images, encode_cursor(images[-1].hits, images[-1].id)
+
+    def _paginated_query(self, size, tags=None, after=None):
         query = self.session.query(Image)
 
         if tags:
@@ -145,15 +306,119 @@ class DBClient:
                 .join(Image, Image.id == tag_relationship._columns.image_id)
             )
 
-            tag = tags.pop()
-            query = stmt.filter(Tag.name.like(f"%{tag}%"))
-            self.touch_tag(tag)
+            tag, *tags = tags
+            query = stmt.filter(Tag.id.in_(self.match_tags(tag)))
 
             # this might be slow
             for tag in tags:
-                self.touch_tag(tag)
-                query = query.intersect(stmt.filter(Tag.name.like(f"%{tag}%")))
-        return query.order_by(desc(Image.hits)).offset(start).limit(size).all()
+                query = query.intersect(stmt.filter(Tag.id.in_(self.match_tags(tag))))
+
+        if after is not None:
+            # uses ix_image_hits_id
+            query = query.filter(tuple_(Image.hits, Image.id) < after)
+        return query.order_by(desc(Image.hits), desc(Image.id)).limit(size)
+
+    def match_tags(self, name):
+        return match_tags(name, fts=self.fts)
+
+    def read_page(self, size, tags=None, cursor=None, with_tags=True, touch=True):
+        """get_paginated_result for the templates"""
+        images, cursor = self.get_paginated_result(size, tags=tags, cursor=cursor, touch=touch)
+        return self.image_records(images, with_tags), cursor
+
+    def read_image(self, id, with_tags=True):
+        return self.image_records([self.query_image(id=id)], with_tags)[0]
+
+    def image_records(self, images, with_tags=True):
+        """
+        ImageRecords of the images. The tags of all of them are fetched in one
+        query, never through the lazy Image.tags.
+        """
+        tags = {image.id: [] for image in images}
+        if with_tags and tags:
+            rows = self.session.execute(
+                select(tag_relationship.c.image_id, Tag.name)
+                .join(Tag, Tag.id == tag_relationship.c.tag_id)
+                .where(tag_relationship.c.image_id.in_(list(tags)))
+            )
+            for image_id, name in rows:
+                tags[image_id].append(name)
+        return [
+            ImageRecord(image.id, image.name, image.path, image.hits, tuple(tags[image.id]))
+            for image in images
+        ]
+
+    def get_images(self, ids):
+        """Images with the given ids, in the same order"""
+        if not ids:
+            return []
+        images = {
+            image.id: image
+            for image in self.session.query(Image).filter(Image.id.in_(ids))
+        }
+        return [images[id] for id in ids if id in images]
+
+    def get_hashes(self, size):
+        """(quick_hash, content_hash) of the images with the same size"""
+        return (
+            self.session.query(Image.quick_hash, Image.content_hash)
+            .filter(Image.size == size)
+            .all()
+        )
+
+    def missing_phashes(self):
+        """(id, path) of the images without a perceptual hash that weren't tried yet"""
+        return self.session.execute(
+            select(Image.id, Image.path)
+            .where(Image.phash.is_(None))
+            .where(Image.phash_failed == False)
+            .order_by(Image.id)
+        ).all()
+
+    def set_phashes(self, hashes, failed=()):
+        """{image_id: phash} and the ids of the images that failed in one transaction"""
+        if not hashes and not failed:
+            return
+        with self.session.begin():
+            if hashes:
+                self.session.execute(
+                    update(Image)
+                    .where(Image.id == bindparam("image_id"))
+                    .values(phash=bindparam("value"))
+                    .execution_options(synchronize_session=False),
+                    [{"image_id": id, "value": value} for id, value in hashes.items()],
+                )
+            for ids in chunked(failed, IN_LIMIT):
+                self.session.execute(
+                    update(Image)
+                    .where(Image.id.in_(ids))
+                    .values(phash_failed=True)
+                    .execution_options(synchronize_session=False)
+                )
+
+    def main_queries(self):
+        """The statements of the hot paths, for EXPLAIN QUERY PLAN"""
+        return {
+            "page": self._paginated_query(50, after=(0, 0)).statement,
+            "page by tags": self._paginated_query(50, ["hair", "eyes"]).statement,
+            "less tagged": self.session.query(Image)
+            .where(Image.tag_count < 1)
+            .order_by(Image.tag_count)
+            .limit(200)
+            .statement,
+            "popular tags": self.session.query(Tag)
+            .order_by(desc(Tag.usage_count))
+            .limit(35)
+            .statement,
+            "image tags": select(tag_relationship.c.image_id, Tag.name)
+            .join(Tag, Tag.id == tag_relationship.c.tag_id)
+            .where(tag_relationship.c.image_id.in_([1, 2, 3])),
+            "tagged ids": self.get_tagged_ids([1, 2]).statement,
+            "popular tags ids": self.get_popular_tags_ids([1, 2, 3], [1]).statement,
+            "hashes": self.session.query(Image.quick_hash, Image.content_hash)
+            .filter(Image.size == 1024)
+            .statement,
+        }
 
     def get_tag(self, id):
         return self.session.query(Tag.name).filter(Tag.id == id).scalar()
@@ -169,20 +434,43 @@ class DBClient:
         return tag
 
     def delete_tag(self, name):
-        tag = self.session.query(Tag).filter(Tag.name == name).one()
-        self.session.delete(tag)
+        with self.session.begin():
+            tag = self.session.query(Tag).filter(Tag.name == name).one()
+            tagged = select(tag_relationship.c.image_id).where(
+                tag_relationship.c.tag_id == tag.id
+            )
+            self.session.execute(
+                update(Image)
+                .where(Image.id.in_(tagged))
+                .values(tag_count=Image.tag_count - 1)
+                .execution_options(synchronize_session=False)
+            )
+            self.session.delete(tag)
+        if self.index is not None:
+            self.index.remove_tag(name)
+        self.invalidate()
 
     def get_most_used_tags(self):
         return self.session.query(Tag).order_by(desc(Tag.hits)).limit(30).all()
 
     def get_most_popular_tags(self, limit=35):
-        """SELECT tag.name FROM tag ORDER BY (SELECT count(assoc_tagged_image.tag_id) FROM assoc_tagged_image WHERE assoc_tagged_image.tag_id = tag.id) DESC;"""
-        count_matches = (
-            select(func.count(tag_relationship._columns.tag_id))
-            .where(tag_relationship._columns.tag_id == Tag.id)
-            .scalar_subquery()
-        )
-        return self.session.query(Tag).order_by(desc(count_matches)).limit(limit).all()
+        """SELECT tag.name FROM tag ORDER BY usage_count DESC;"""
+        return self.session.query(Tag).order_by(desc(Tag.usage_count)).limit(limit).all()
+
+    def suggest_tags(self, tags, limit=35):
+        """
+        Names of the tags that go with `tags` (see TagIndex.suggest), the
+        most popular ones fill the rest
+        """
+        suggested = self.index.suggest(tags, limit) if self.index is not None else []
+        if len(suggested) < limit:
+            popular = self.cached(
+                ("popular_tag_names", limit),
+                lambda: [tag.name for tag in self.get_most_popular_tags(limit)],
+            )
+            seen = set(tags) | set(suggested)
+            suggested += [name for name in popular if name not in seen][: limit - len(suggested)]
+        return suggested
 
     def query_image(self, id=None, path=None):
         query = self.session.query(Image)
@@ -192,20 +480,68 @@ class DBClient:
             query = query.filter(Image.path == path)
         return query.one()
 
-    def add_image(self, name, path, tags, classified):
-        tag_list = [self.add_tag(tag) for tag in tags]
-        new_image = Image(name=name, path=path, classified=classified)
-        new_image.tags.extend(tag_list)
-
-        self.session.add(new_image)
+    def add_image(self, name, path, tags):
+        tags = list(dict.fromkeys(tags))
+        with self.session.begin():
+            tag_list = [self.add_tag(tag) for tag in tags]
+            new_image = Image(name=name, path=path, tag_count=len(tag_list))
+            new_image.tags.extend(tag_list)
+
+            self.session.add(new_image)
+            self.session.flush()
+            self._add_usage([tag.id for tag in tag_list], 1)
+        if self.index is not None:
+            self.index.add(new_image.id, tags)
+        self.invalidate()
+        return new_image
 
     def delete_image(self, id):
-        image = self.session.query(Image).filter(Image.id == id).one()
-        self.logger.info(f"DELETing image {image.name} from {image.path}")
-        self.session.delete(image)
+        with self.session.begin():
+            image = self.session.query(Image).filter(Image.id == id).one()
+            self.logger.info(f"DELETing image {image.name} from {image.path}")
+            tag_ids = [tag.id for tag in image.tags]
+            self.session.delete(image)
+            self.session.flush()
+            self._add_usage(tag_ids, -1)
+        if self.index is not None:
+            self.index.remove(id)
+        self.invalidate()
         # remove from the filesystem
         os.remove(image.path)
 
+    def _add_usage(self, tag_ids, amount):
+        """Keeps tag.usage_count in sync. Call it in the same transaction"""
+        counts = Counter(tag_ids)
+        if not counts:
+            return
+        self.session.execute(
+            update(Tag)
+            .where(Tag.id == bindparam("tag_id"))
+            .values(usage_count=Tag.usage_count + bindparam("amount"))
+            .execution_options(synchronize_session=False),
+            [{"tag_id": id, "amount": n * amount} for id, n in counts.items()],
+        )
+
+    def recount(self):
+        """Recomputes tag.usage_count and image.tag_count from scratch"""
+        with self.session.begin():
+            self.session.execute(
+                update(Tag).values(
+                    usage_count=select(func.count())
+                    .where(tag_relationship.c.tag_id == Tag.id)
+                    .scalar_subquery()
+                )
+            )
+            self.session.execute(
+                update(Image).values(
+                    tag_count=select(func.count())
+                    .where(tag_relationship.c.image_id == Image.id)
+                    .scalar_subquery()
+                )
+            )
+        self.invalidate()
+        self.logger.info("Recounted the tags of %d images", self.count_images())
+
     def most_used_images(self):
         images = self.session.query(Image).order_by(desc(Image.hits)).limit(10)
         return images
@@ -218,30 +554,111 @@ class DBClient:
             params["name"] = name
         if path is not None:
             params["path"] = path
-            query = query.values(path=path)
         if tags is not None:
-            _tags = [self.add_tag(tag) for tag in tags]
-            img = self.session.query(Image).filter(Image.id == id).one()
-            img.tags = _tags
-            self.session.add(img)
-
-        if params:
-            self.session.execute(stmt.values(**params))
+            tags = list(dict.fromkeys(tags))
+        with self.session.begin():
+            if tags is not None:
+                _tags = [self.add_tag(tag) for tag in tags]
+                img = self.session.query(Image).filter(Image.id == id).one()
+                old = {tag.id for tag in img.tags}
+                img.tags = _tags
+                img.tag_count = len(_tags)
+                self.session.flush()
+
+                new = {tag.id for tag in _tags}
+                self._add_usage(new - old, 1)
+                self._add_usage(old - new, -1)
+
+            if params:
+                self.session.execute(stmt.values(**params))
+
+        if tags is not None and self.index is not None:
+            self.index.update(id, tags)
+        self.invalidate()
 
         self.logger.info("Updated image %d. Params %s. Tags %s", id, params, tags)
 
-    def touch_image(self, id):
+    def set_tags(self, tags):
+        """
+        Replaces the tags of many images ({image_id: [tag names]}) in one
+        transaction
+        """
+        tags = {id: list(dict.fromkeys(names)) for id, names in tags.items()}
+        if not tags:
+            return
+        with self.session.begin():
+            old = []
+            for ids in chunked(tags, IN_LIMIT):
+                old.extend(
+                    self.session.execute(
+                        select(tag_relationship.c.tag_id).where(
+                            tag_relationship.c.image_id.in_(ids)
+                        )
+                    ).scalars()
+                )
+                self.session.execute(
+                    tag_relationship.delete().where(tag_relationship.c.image_id.in_(ids))
+                )
+            self._add_usage(old, -1)
+            tag_ids = self.resolve_tags({name for names in tags.values() for name in names})
+
+            assoc = [
+                {"image_id": id, "tag_id": tag_ids[name]}
+                for id, names in tags.items()
+                for name in names
+            ]
+            if assoc:
+                self.session.execute(insert(tag_relationship), assoc)
+                self._add_usage([row["tag_id"] for row in assoc], 1)
+            self.session.execute(
+                update(Image)
+                .where(Image.id == bindparam("image_id"))
+                .values(tag_count=bindparam("count"))
+                .execution_options(synchronize_session=False),
+                [{"image_id": id, "count": len(names)} for id, names in tags.items()],
+            )
 
-        self.session.query(Image).filter(Image.id == id).update(
-            {Image.hits: Image.hits + 1}, synchronize_session=False
-        )
-        self.logger.debug(f"Updated image {id} with hits {Image.hits + 1}")
+        if self.index is not None:
+            for id, names in tags.items():
+                self.index.update(id, names)
+        self.invalidate()
+        self.logger.info("Updated the tags of %d images", len(tags))
+
+    def touch_image(self, id):
+        if self.hits is not None:
+            self.hits.touch_image(id)
+            return
+        self.flush_hits({id: 1}, {})
 
     def touch_tag(self, name):
-        self.session.query(Tag).filter(Tag.name.like(f"%{name}%")).update(
-            {Tag.hits: Tag.hits + 1}, synchronize_session="fetch"
-        )
-        self.logger.debug(f"Updated tag {name} with hits {Tag.hits + 1}")
+        if self.hits is not None:
+            self.hits.touch_tag(name)
+            return
+        self.flush_hits({}, {name: 1})
+
+    def flush_hits(self, images, tags):
+        """Adds the hits ({image_id: hits}, {tag_name: hits}) in one transaction"""
+        with self.session.begin():
+            if images:
+                self.session.execute(
+                    update(Image)
+                    .where(Image.id == bindparam("image_id"))
+                    .values(hits=Image.hits + bindparam("amount"))
+                    .execution_options(synchronize_session=False),
+                    [{"image_id": id, "amount": amount} for id, amount in images.items()],
+                )
+            for name, amount in tags.items():
+                self.session.execute(
+                    update(Tag)
+                    .where(Tag.id.in_(self.match_tags(name)))
+                    .values(hits=Tag.hits + amount)
+                    .execution_options(synchronize_session=False)
+                )
+
+        if self.index is not None:
+            for id, amount in images.items():
+                self.index.touch(id, amount)
+        self.logger.debug("Added hits. Images %s. Tags %s", images, tags)
 
     def get_popular_tags_ids(self, ids=None, t_ids=None, min_elements=5):
         query = self.session.query(tag_relationship).subquery()
@@ -284,36 +701,67 @@ class DBClient:
             query = query.filter(tag_relationship._columns.image_id.not_in(except_))
         return query
 
-    def make_tree(self, all_ids=None, current_tags=None, already_queried=None):
-        current_tags = current_tags or []
-        # first time is just 1, 2... n
-        all_ids = all_ids or set(
-            map(
-                lambda i: i[0],
-                self.session.query(tag_relationship._columns.image_id).all(),
-            )
-        )
+    def make_tree(self, min_elements=5, exporter=None, progress=None):
+        """
+        Writes the tagged images in folders named after their most common
+        tags. Only what changed since the last export is touched. Returns
+        the stats of the export
+        """
+        # export imports ingest which imports this module
+        from rp_tagger.export import Exporter
 
-        res = self.get_popular_tags_ids(ids=all_ids, t_ids=current_tags)
-        res_sq = res.subquery()
-        i = (
-            self.session.query(tag_relationship._columns.image_id)
-            .join(res_sq, tag_relationship.columns.tag_id == res_sq.columns.tag_id)
-            .all()
-        )
-        new_ids = set(map(lambda e: e[0], i))
-        pruned = all_ids.difference(new_ids)
-        self.dump_images(pruned, current_tags)
-        self.already_queried.extend(pruned)
-        print(self.already_queried)
+        exporter = exporter or Exporter()
+        return exporter.export(self, self.tree(min_elements), progress=progress)
 
-        tags = list(map(lambda i: i[0], res.all()))
-        for tag in tags:
-            res = self.get_tagged_ids(current_tags + [tag], self.already_queried)
+    def tree(self, min_elements=5):
+        """
+        Splits the tagged images in groups. At every level the images are
+        split by the tags more than `min_elements` of them have, most
+        common first (ties by tag id), an image goes to the first of its
+        tags and the ones with none of them stay at that level. Returns the
+        (tag ids, image ids) of every group, depth first.
+
+        All the associations are read in one query and the rest happens in
+        memory.
+        """
+        tags_of = {}
+        rows = self.session.execute(
+            select(tag_relationship.c.image_id, tag_relationship.c.tag_id)
+        )
+        for image_id, tag_id in rows:
+            tags_of.setdefault(image_id, []).append(tag_id)
+
+        groups = []
+        self._tree(list(tags_of), [], tags_of, set(), groups, min_elements)
+        return groups
+
+    def _tree(self, ids, path, tags_of, done, groups, min_elements):
+        excluded = set(path)
+        counts = Counter(tag for id in ids for tag in tags_of[id] if tag not in excluded)
+        popular = sorted(
+            (tag for tag, count in counts.items() if count > min_elements),
+            key=lambda tag: (-counts[tag], tag),
+        )
 
-            img_ids = set(map(lambda i: i[0], res.all()))
-            if img_ids:
-                self.make_tree(img_ids, current_tags + [tag], self.already_queried)
+        buckets = {tag: [] for tag in popular}
+        pruned = []
+        for id in ids:
+            found = False
+            for tag in tags_of[id]:
+                if tag in buckets:
+                    buckets[tag].append(id)
+                    found = True
+            if not found:
+                pruned.append(id)
+
+        if pruned:
+            groups.append((path, pruned))
+            done.update(pruned)
+        for tag in popular:
+            # the images of the previous tags are already in their folders
+            tagged = [id for id in buckets[tag] if id not in done]
+            if tagged:
+                self._tree(tagged, path + [tag], tags_of, done, groups, min_elements)
 
     def _make_tree(self, query=None, current_tags=None):
         raise NotImplementedError("Kept for historical reasons.")
@@ -367,16 +815,8 @@ class DBClient:
             )
 
     def dump_images(self, images, current_tags=None):
-        current_tags = current_tags or []
-        # write the images on the filesystem
-        for image_id in images:
-            image = self.query_image(id=image_id)
-            path = settings.IMAGES_DIR
-            for tag in current_tags:
-                tag_name = self.get_tag(tag)
-                path = path / tag_name
-            try:
-                os.makedirs(path)
-            except FileExistsError:
-                pass
-            shutil.copy(image.path, path / image.name)
+        """Writes the images in the folder of the tags, without a manifest"""
+        from rp_tagger.export import Exporter
+
+        exporter = Exporter(manifest_path=None)
+        return exporter.export(self, [(current_tags or [], images)], prune=False)
@@ -0,0 +1,716 @@
+"""
+Batched auto tagging with the deepdanbooru model of hydrus-dd. The model is
+loaded once per process and the images go through it `batch_size` at a time
+while a pool of processes decodes the next ones.
+"""
+import os
+import time
+import hashlib
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+
+from sqlalchemy import delete, func, insert, select, update
+
+from rp_tagger.api import IN_LIMIT, chunked
+from rp_tagger.conf import settings
+from rp_tagger.db import AutotagChunk, AutotagJob, Image, InferenceScore
+from rp_tagger.log import logged
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    os.environ.setdefault("CUDA_VISIBLE_DEVICES", "-1")
+    from deepdanbooru.data import load_image_for_evaluate
+    from hydrus_dd.__main__ import load_model_and_tags
+except ImportError:
+    load_image_for_evaluate = load_model_and_tags = None
+
+# how the scores are kept in the cache, 4 bytes per tag
+SCORE_DTYPE = np and np.dtype([("tag", "<u2"), ("score", "<f2")])
+
+
+@lru_cache(maxsize=None)
+def load_model(model_dir=settings.MODEL_DIR):
+    """(model, tags) of `model_dir`. Loading takes seconds so it's done once"""
+    model_dir = os.fspath(model_dir)
+    return load_model_and_tags(
+        os.path.join(model_dir, "model.h5"), os.path.join(model_dir, "tags.txt"), compile_=None
+    )
+
+
+@lru_cache(maxsize=None)
+def model_fingerprint(model_dir=settings.MODEL_DIR):
+    """Hash of the model and its tags. The cached scores are only valid for it"""
+    digest = hashlib.sha256()
+    for name in ("model.h5", "tags.txt"):
+        with open(os.path.join(os.fspath(model_dir), name), "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def encode_scores(scores, top_k, min_score):
+    """The `top_k` scores over `min_score` packed as SCORE_DTYPE"""
+    assert len(scores) <= 1 << 16, "Too many tags for the cache"
+    top = np.argpartition(scores, -top_k)[-top_k:] if len(scores) > top_k else np.arange(len(scores))
+    top = top[scores[top] >= min_score]
+    top = top[np.argsort(scores[top])[::-1]]
+    packed = np.empty(len(top), dtype=SCORE_DTYPE)
+    packed["tag"] = top
+    packed["score"] = scores[top]
+    return packed.tobytes()
+
+
+def decode_scores(blob):
+    """(tag indexes, scores)"""
+    packed = np.frombuffer(blob, dtype=SCORE_DTYPE)
+    return packed["tag"].astype(np.intp), packed["score"].astype(np.float32)
+
+
+@logged
+class ScoreCache:
+    """
+    Scores of the model by (content hash, model fingerprint). Changing the
+    threshold or tagging an image seen before doesn't need the model.
+    """
+
+    def __init__(
+        self,
+        client,
+        model,
+        top_k=settings.AUTOTAG_CACHE_TOP_K,
+        min_score=settings.AUTOTAG_CACHE_MIN_SCORE,
+    ):
+        self.client = client
+        self.model = model
+        self.top_k = top_k
+        self.min_score = min_score
+
+    def get(self, hashes):
+        """{content_hash: (tag indexes, scores)} of the ones in the cache"""
+        found = {}
+        for chunk in chunked(set(hashes), IN_LIMIT):
+            rows = self.client.session.execute(
+                select(InferenceScore.content_hash, InferenceScore.scores).where(
+                    InferenceScore.model == self.model,
+                    InferenceScore.content_hash.in_(chunk),
+                )
+            )
+            found.update((content_hash, decode_scores(blob)) for content_hash, blob in rows)
+        return found
+
+    def put(self, scores):
+        """Saves {content_hash: scores of every tag}"""
+        if not scores:
+            return
+        rows = [
+            {
+                "content_hash": content_hash,
+                "model": self.model,
+                "scores": encode_scores(row, self.top_k, self.min_score),
+                "created_at": datetime.now(),
+            }
+            for content_hash, row in scores.items()
+        ]
+        with self.client.session.begin():
+            self.client.session.execute(insert(InferenceScore).prefix_with("OR REPLACE"), rows)
+
+    def prune(self, keep_model=True):
+        """
+        Forgets the scores of images that are gone and, with `keep_model`,
+        the ones of other models. Returns the number of rows deleted
+        """
+        condition = InferenceScore.content_hash.not_in(
+            select(Image.content_hash).where(Image.content_hash.is_not(None))
+        )
+        if keep_model:
+            condition = condition | (InferenceScore.model != self.model)
+        with self.client.session.begin():
+            deleted = self.client.session.execute(
+                delete(InferenceScore).where(condition).execution_options(synchronize_session=False)
+            ).rowcount
+        self.logger.info("Pruned %d scores", deleted)
+        return deleted
+
+
+def decode_image(path, width, height, loader=None):
+    """
+    Runs in the decode workers. Returns (array, error, seconds), the error
+    is set when the file can't be read
+    """
+    start = time.perf_counter()
+    try:
+        array = (loader or load_image_for_evaluate)(path, width=width, height=height)
+        error = None
+    except Exception as exc:
+        array, error = None, f"{exc.__class__.__name__}: {exc}"
+    return array, error, time.perf_counter() - start
+
+
+@logged
+class AutoTagger:
+    """
+    Tags the untagged images. One `model.predict` per batch of
+    `batch_size` images and one transaction per batch for the tags.
+
+    With `workers` the images are decoded and resized in that many
+    processes (or threads, `pool`), at most `prefetch` batches ahead of the
+    model. `loader` is what reads an image (deepdanbooru's by default), it
+    must be picklable.
+
+    With `cache` the scores are looked up in the ScoreCache first and the
+    new ones saved.
+    """
+
+    STAGES = ("decode", "wait", "inference", "write")
+
+    def __init__(
+        self,
+        model_dir=settings.MODEL_DIR,
+        batch_size=settings.AUTOTAG_BATCH_SIZE,
+        threshold=settings.AUTOTAG_THRESHOLD,
+        workers=settings.AUTOTAG_DECODE_WORKERS,
+        prefetch=settings.AUTOTAG_PREFETCH,
+        loader=None,
+        cache=settings.AUTOTAG_CACHE,
+        pool=settings.AUTOTAG_DECODE_POOL,
+    ):
+        self.model_dir = model_dir
+        self.batch_size = batch_size
+        self.threshold = threshold
+        self.workers = workers
+        self.pool = pool
+        self.prefetch = prefetch
+        self.loader = loader
+        self.cache = cache
+        self.reset_stats()
+
+    def reset_stats(self):
+        # seconds spent in every stage. "decode" is added up over the
+        # workers, "wait" is the model waiting for them
+        self.stats = dict.fromkeys(self.STAGES, 0.0)
+        self.stats.update(images=0, tagged=0, skipped=0, cached=0)
+
+    def status(self):
+        status = dict(self.stats)
+        images = status["images"]
+        for stage in self.STAGES:
+            status[f"{stage}_per_image"] = status[stage] / images if images else None
+        return status
+
+    @staticmethod
+    def available():
+        return np is not None and load_model_and_tags is not None
+
+    @property
+    def model(self):
+        return load_model(self.model_dir)[0]
+
+    @property
+    def tags(self):
+        return load_model(self.model_dir)[1]
+
+    def predict(self, batch):
+        """Scores of every tag, one row per image"""
+        return self.model.predict(batch, batch_size=len(batch))
+
+    def guess(self, scores, indexes=None):
+        """Tags over the threshold. `indexes` are the tags of `scores` if they aren't all"""
+        tags = self.tags
+        over = np.flatnonzero(scores >= self.threshold)
+        if indexes is not None:
+            over = indexes[over]
+        return [tags[i] for i in over]
+
+    def score_cache(self, client):
+        if not self.cache or client is None:
+            return None
+        return ScoreCache(client, model_fingerprint(self.model_dir))
+
+    def tag_images(self, images, client=None):
+        """
+        Yields (image, tags), not necessarily in order. The images that
+        can't be read are skipped. The cache is used if there's a `client`
+        and the threshold isn't under the scores it keeps
+        """
+        cache = self.score_cache(client)
+        cached = deque()
+        if cache is not None and self.threshold >= cache.min_score:
+            images = self._lookup(images, cache, cached)
+
+        for batch, arrays in self.decode(images):
+            start = time.perf_counter()
+            scores = self.predict(arrays)
+            self.stats["inference"] += time.perf_counter() - start
+            self.stats["images"] += len(batch)
+            if cache is not None:
+                cache.put(
+                    {image.content_hash: row for image, row in zip(batch, scores) if image.content_hash}
+                )
+            while cached:
+                yield cached.popleft()
+            for image, row in zip(batch, scores):
+                yield image, self.guess(row)
+        while cached:
+            yield cached.popleft()
+
+    def _lookup(self, images, cache, cached):
+        """Yields the images the cache doesn't know, the others go to `cached` with their tags"""
+        for chunk in chunked(images, self.batch_size):
+            found = cache.get(image.content_hash for image in chunk if image.content_hash)
+            for image in chunk:
+                indexes, scores = found.get(image.content_hash, (None, None))
+                # with top_k scores over the threshold the next ones could be too
+                if scores is not None and (len(scores) < cache.top_k or scores[-1] < self.threshold):
+                    self.stats["cached"] += 1
+                    cached.append((image, self.guess(scores, indexes)))
+                else:
+                    yield image
+
+    def decode(self, images):
+        """Yields (images, array) batches ready for the model"""
+        _, height, width, _ = self.model.input_shape
+        if not self.workers:
+            results = (
+                (image, decode_image(image.path, width, height, self.loader)) for image in images
+            )
+            yield from self._batches(results)
+            return
+
+        with self.decode_pool() as pool:
+            yield from self._batches(self._prefetch(pool, images, width, height))
+
+    def decode_pool(self):
+        """
+        The workers that decode the images. The processes are spawned, the
+        model is loaded by then and tensorflow doesn't survive a fork
+        """
+        if self.pool == "thread":
+            return ThreadPoolExecutor(self.workers, thread_name_prefix="decode")
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _prefetch(self, pool, images, width, height):
+        """
+        (image, result of decode_image) in order. There are never more than
+        `prefetch` batches being decoded or waiting for the model
+        """
+        pending = deque()
+        limit = max(self.prefetch, 1) * self.batch_size
+        for image in images:
+            future = pool.submit(decode_image, image.path, width, height, self.loader)
+            pending.append((image, future))
+            if len(pending) >= limit:
+                image, future = pending.popleft()
+                yield image, future.result()
+        while pending:
+            image, future = pending.popleft()
+            yield image, future.result()
+
+    def _batches(self, results):
+        batch, arrays = [], []
+        results = iter(results)
+        while True:
+            start = time.perf_counter()
+            try:
+                image, (array, error, seconds) = next(results)
+            except StopIteration:
+                break
+            self.stats["wait"] += time.perf_counter() - start
+            self.stats["decode"] += seconds
+            if error is not None:
+                self.stats["skipped"] += 1
+                self.logger.warning("Skipping %s. Can't read it: %s", image.path, error)
+                continue
+            batch.append(image)
+            arrays.append(array)
+            if len(batch) == self.batch_size:
+                yield batch, np.stack(arrays)
+                batch, arrays = [], []
+        if batch:
+            yield batch, np.stack(arrays)
+
+    def untagged(self, client):
+        """Every untagged image, a page at a time"""
+        after_id = 0
+        while True:
+            images = client.load_less_tagged_images(after_id=after_id)
+            if not images:
+                return
+            yield from images
+            after_id = images[-1].id
+
+    def run(self, client):
+        """Tags every untagged image. Returns the number of images tagged"""
+        self.reset_stats()
+        start = time.monotonic()
+        for batch in chunked(self.tag_images(self.untagged(client), client), self.batch_size):
+            tags = {image.id: names for image, names in batch if names}
+            write_start = time.perf_counter()
+            client.set_tags(tags)
+            self.stats["write"] += time.perf_counter() - write_start
+            self.stats["tagged"] += len(tags)
+            self.logger.info(
+                "Tagged %d images. %.2f images/s",
+                self.stats["tagged"],
+                self.stats["tagged"] / (time.monotonic() - start),
+            )
+        self.logger.info(
+            "Done. %d tagged, %d skipped, %d from the cache. Seconds per stage: %s",
+            self.stats["tagged"],
+            self.stats["skipped"],
+            self.stats["cached"],
+            ", ".join(f"{stage} {self.stats[stage]:.2f}" for stage in self.STAGES),
+        )
+        return self.stats["tagged"]
+
+
+@logged
+class AutotagQueue:
+    """
+    Work queue of the auto tagging jobs, kept in the DB so a job survives
+    a restart. Every process uses its own.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    @property
+    def session(self):
+        return self.client.session
+
+    def get_job(self, job_id):
+        return self.session.query(AutotagJob).filter(AutotagJob.id == job_id).one()
+
+    def active_job(self):
+        """The job that is pending or running, if any"""
+        return (
+            self.session.query(AutotagJob)
+            .filter(AutotagJob.status.in_(("pending", "running")))
+            .order_by(AutotagJob.id)
+            .first()
+        )
+
+    def create_job(self, chunk_size=settings.AUTOTAG_CHUNK_SIZE, threshold=None):
+        """Splits the untagged images in chunks of `chunk_size`"""
+        with self.session.begin():
+            job = AutotagJob(status="pending", total=0, threshold=threshold)
+            self.session.add(job)
+            self.session.flush()
+
+            ids = self.session.execute(
+                self.client.untagged_query(Image.id).order_by(Image.id)
+            ).scalars()
+            chunks = [
+                {"job_id": job.id, "start_id": chunk[0], "end_id": chunk[-1], "images": len(chunk)}
+                for chunk in chunked(ids, chunk_size)
+            ]
+            if chunks:
+                self.session.execute(insert(AutotagChunk), chunks)
+            job.total = sum(chunk["images"] for chunk in chunks)
+        self.logger.info("Created job %d. %d images in %d chunks", job.id, job.total, len(chunks))
+        return job.id
+
+    def start(self, job_id):
+        """Marks the job as running. Chunks left running by a crash go back to the queue"""
+        with self.session.begin():
+            self.session.execute(
+                update(AutotagChunk)
+                .where(AutotagChunk.job_id == job_id, AutotagChunk.status == "running")
+                .values(status="pending", worker=None, claimed_at=None)
+            )
+            self.session.execute(
+                update(AutotagJob)
+                .where(AutotagJob.id == job_id)
+                .values(status="running", resumed_at=datetime.now(), finished_at=None)
+            )
+
+    def cancel(self, job_id):
+        with self.session.begin():
+            self.session.execute(
+                update(AutotagJob)
+                .where(AutotagJob.id == job_id, AutotagJob.status.in_(("pending", "running")))
+                .values(status="cancelled", finished_at=datetime.now())
+            )
+
+    def is_running(self, job_id):
+        return self.session.execute(
+            select(AutotagJob.status).where(AutotagJob.id == job_id)
+        ).scalar() == "running"
+
+    def claim(self, job_id, worker):
+        """Takes the next pending chunk. None when there are no more"""
+        while True:
+            chunk = self.session.execute(
+                select(AutotagChunk.id, AutotagChunk.start_id, AutotagChunk.end_id)
+                .where(AutotagChunk.job_id == job_id, AutotagChunk.status == "pending")
+                .order_by(AutotagChunk.id)
+                .limit(1)
+            ).first()
+            if chunk is None:
+                return None
+            with self.session.begin():
+                claimed = self.session.execute(
+                    update(AutotagChunk)
+                    .where(AutotagChunk.id == chunk.id, AutotagChunk.status == "pending")
+                    .values(status="running", worker=worker, claimed_at=datetime.now())
+                ).rowcount
+            # another worker took it first otherwise
+            if claimed:
+                return chunk
+
+    def finish(self, chunk_id, tagged, error=None, stats=None):
+        """`stats` are the ones of the AutoTagger that did the chunk"""
+        values = {}
+        if stats is not None:
+            values = {f"{stage}_seconds": stats[stage] for stage in AutoTagger.STAGES}
+            values.update(cached=stats["cached"], skipped=stats["skipped"])
+        with self.session.begin():
+            self.session.execute(
+                update(AutotagChunk)
+                .where(AutotagChunk.id == chunk_id)
+                .values(
+                    status="failed" if error else "done",
+                    tagged=tagged,
+                    error=error,
+                    finished_at=datetime.now(),
+                    **values,
+                )
+            )
+
+    def close(self, job_id):
+        """Done once every chunk was taken care of, failed if some are left"""
+        counts = self.chunk_counts(job_id)
+        with self.session.begin():
+            job = self.get_job(job_id)
+            if job.status == "running":
+                left = counts.get("pending", 0) + counts.get("running", 0)
+                job.status = "failed" if left else "done"
+                job.finished_at = datetime.now()
+        return job.status
+
+    def last_job(self):
+        return self.session.query(AutotagJob).order_by(AutotagJob.id.desc()).first()
+
+    def stage_times(self, job_id):
+        """
+        Seconds spent decoding, waiting for the decoders, in the model and
+        writing by the finished chunks of the job, in total and per image
+        """
+        stages = [func.sum(getattr(AutotagChunk, f"{stage}_seconds")) for stage in AutoTagger.STAGES]
+        row = self.session.execute(
+            select(
+                func.sum(AutotagChunk.images),
+                func.sum(AutotagChunk.cached),
+                func.sum(AutotagChunk.skipped),
+                *stages,
+            ).where(AutotagChunk.job_id == job_id, AutotagChunk.status.in_(("done", "failed")))
+        ).one()
+        images = row[0] or 0
+        status = {"job_id": job_id, "images": images, "cached": row[1] or 0, "skipped": row[2] or 0}
+        for stage, seconds in zip(AutoTagger.STAGES, row[3:]):
+            status[stage] = seconds or 0.0
+            status[f"{stage}_per_image"] = status[stage] / images if images else None
+        return status
+
+    def chunk_counts(self, job_id):
+        return dict(
+            self.session.execute(
+                select(AutotagChunk.status, func.count())
+                .where(AutotagChunk.job_id == job_id)
+                .group_by(AutotagChunk.status)
+            ).all()
+        )
+
+    def progress(self, job_id):
+        """Status of the job with the images processed, tagged and the ETA in seconds"""
+        job = self.get_job(job_id)
+        status = job.as_dict()
+        rows = self.session.execute(
+            select(
+                AutotagChunk.status,
+                func.count(),
+                func.sum(AutotagChunk.images),
+                func.sum(AutotagChunk.tagged),
+            )
+            .where(AutotagChunk.job_id == job_id)
+            .group_by(AutotagChunk.status)
+        ).all()
+        status["chunks"] = {row[0]: row[1] for row in rows}
+        finished = [row for row in rows if row[0] in ("done", "failed")]
+        status["processed"] = sum(row[2] or 0 for row in finished)
+        status["tagged"] = sum(row[3] or 0 for row in finished)
+        status["progress"] = status["processed"] / job.total if job.total else 1.0
+
+        status["eta"] = None
+        if job.status == "running" and job.resumed_at is not None:
+            # the rate since the workers were started
+            since = self.session.execute(
+                select(func.sum(AutotagChunk.images)).where(
+                    AutotagChunk.job_id == job_id,
+                    AutotagChunk.finished_at >= job.resumed_at,
+                )
+            ).scalar()
+            elapsed = (datetime.now() - job.resumed_at).total_seconds()
+            if since and elapsed:
+                status["eta"] = (job.total - status["processed"]) / (since / elapsed)
+        return status
+
+
+def work(client, job_id, tagger, worker="main"):
+    """Tags chunks of the job until there are none left or it's cancelled"""
+    queue = AutotagQueue(client)
+    while queue.is_running(job_id):
+        chunk = queue.claim(job_id, worker)
+        if chunk is None:
+            return
+        tagged, error = 0, None
+        tagger.reset_stats()
+        try:
+            images = client.load_less_tagged_images(
+                limit=None, after_id=chunk.start_id - 1, until_id=chunk.end_id
+            )
+            for batch in chunked(tagger.tag_images(images, client), tagger.batch_size):
+                start = time.perf_counter()
+                client.set_tags({image.id: names for image, names in batch if names})
+                tagger.stats["write"] += time.perf_counter() - start
+                tagged += sum(1 for _, names in batch if names)
+        except Exception as exc:
+            queue.logger.exception("%s failed on chunk %d", worker, chunk.id)
+            error = f"{exc.__class__.__name__}: {exc}"
+        queue.finish(chunk.id, tagged, error, tagger.stats)
+        # the identity map doesn't need to remember the chunk
+        client.remove()
+
+
+def configure_threads(threads):
+    """Has to be called before the model is loaded"""
+    try:
+        import tensorflow as tf
+    except ImportError:
+        return
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def autotag_worker(job_id, threads, batch_size, model_dir, decode_workers):
+    """Entry point of the worker processes"""
+    from rp_tagger.api import DBClient
+
+    configure_threads(threads)
+    client = DBClient(index=None)
+    threshold = AutotagQueue(client).get_job(job_id).threshold
+    # a daemon process can't have children, the decoders are threads
+    tagger = AutoTagger(
+        model_dir=model_dir,
+        batch_size=batch_size,
+        threshold=threshold or settings.AUTOTAG_THRESHOLD,
+        workers=decode_workers,
+        pool="thread",
+    )
+    work(client, job_id, tagger, worker=f"worker-{os.getpid()}")
+
+
+@logged
+class AutotagJobs:
+    """
+    Runs the auto tagging jobs in `workers` processes with `threads`
+    TensorFlow threads and `decode_workers` decoding threads each. A
+    monitor thread closes the job when the workers are gone.
+    """
+
+    def __init__(
+        self,
+        client,
+        workers=settings.AUTOTAG_JOB_WORKERS,
+        threads=settings.AUTOTAG_JOB_THREADS,
+        batch_size=settings.AUTOTAG_BATCH_SIZE,
+        model_dir=settings.MODEL_DIR,
+        decode_workers=settings.AUTOTAG_JOB_DECODE_WORKERS,
+    ):
+        self.client = client
+        self.queue = AutotagQueue(client)
+        self.workers = workers
+        self.threads = threads
+        self.decode_workers = decode_workers
+        self.batch_size = batch_size
+        self.model_dir = model_dir
+        self._lock = threading.Lock()
+        self._monitor = None
+
+    def running(self):
+        return self._monitor is not None and self._monitor.is_alive()
+
+    def join(self, timeout=None):
+        """Waits for the workers of the running job"""
+        if self._monitor is not None:
+            self._monitor.join(timeout)
+
+    def start(self, threshold=None):
+        """
+        Starts a new job or resumes the active one, `threshold` is only for
+        new jobs. Returns its id
+        """
+        with self._lock:
+            job = self.queue.active_job()
+            job_id = job.id if job is not None else self.queue.create_job(threshold=threshold)
+            if not self.running():
+                self.queue.start(job_id)
+                self._monitor = threading.Thread(
+                    target=self._run, args=(job_id,), name=f"autotag-{job_id}", daemon=True
+                )
+                self._monitor.start()
+        return job_id
+
+    def resume(self):
+        """Resumes the job interrupted by a restart"""
+        if self.queue.active_job() is not None:
+            return self.start()
+
+    def cancel(self, job_id):
+        self.queue.cancel(job_id)
+
+    def progress(self, job_id):
+        return self.queue.progress(job_id)
+
+    def stage_times(self, job_id=None):
+        """Seconds per stage of the job, the last one by default. None if there are no jobs"""
+        if job_id is None:
+            job = self.queue.last_job()
+            if job is None:
+                return None
+            job_id = job.id
+        return self.queue.stage_times(job_id)
+
+    def _run(self, job_id):
+        # tensorflow doesn't survive a fork
+        context = multiprocessing.get_context("spawn")
+        processes = [
+            context.Process(
+                target=autotag_worker,
+                args=(job_id, self.threads, self.batch_size, self.model_dir, self.decode_workers),
+                name=f"autotag-{job_id}-{i}",
+                daemon=True,
+            )
+            for i in range(self.workers)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        # this thread has its own session
+        queue = AutotagQueue(self.client)
+        status = queue.close(job_id)
+        self.client.remove()
+        self.logger.info("Job %d is %s", job_id, status)
+        # the workers wrote to the DB, not to the index of this process
+        if self.client.index is not None:
+            self.client.index.load(self.client.session)
+            self.client.remove()
@@ -0,0 +1,134 @@
+"""
+Export and import of the library as NDJSON, one image with its tags per
+line. Both ends stream so the memory used doesn't depend on the size of the
+library.
+"""
+import gzip
+import json
+import zlib
+from datetime import datetime
+from itertools import groupby
+from operator import attrgetter
+
+from sqlalchemy import select
+
+from rp_tagger.api import IN_LIMIT, chunked
+from rp_tagger.conf import settings
+from rp_tagger.db import Image, Tag, tag_relationship
+
+DATES = ("last_used", "date_created")
+
+
+def export_images(client, batch_size=settings.DUMP_BATCH_SIZE):
+    """
+    Yields every image as a dict with the names of its tags. The rows are
+    read `batch_size` at a time from one query ordered by image.
+    """
+    stmt = (
+        select(
+            Image.id,
+            Image.name,
+            Image.path,
+            Image.hits,
+            Image.last_used,
+            Image.date_created,
+            Image.size,
+            Image.quick_hash,
+            Image.content_hash,
+            Image.phash,
+            Tag.name.label("tag"),
+        )
+        .select_from(Image)
+        .outerjoin(tag_relationship, tag_relationship.c.image_id == Image.id)
+        .outerjoin(Tag, Tag.id == tag_relationship.c.tag_id)
+        .order_by(Image.id)
+        .execution_options(yield_per=batch_size)
+    )
+    rows = client.session.execute(stmt)
+    for _, group in groupby(rows, key=attrgetter("id")):
+        group = list(group)
+        image = group[0]
+        record = {
+            "name": image.name,
+            "path": image.path,
+            "hits": image.hits,
+            "size": image.size,
+            "quick_hash": image.quick_hash,
+            "content_hash": image.content_hash,
+            "phash": image.phash,
+            "tags": [row.tag for row in group if row.tag is not None],
+        }
+        for key in DATES:
+            value = getattr(image, key)
+            record[key] = value and value.isoformat()
+        yield record
+
+
+def to_ndjson(records):
+    for record in records:
+        yield json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def gzipped(lines, level=6):
+    """Compresses the lines as they come, for the streamed responses"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for line in lines:
+        data = compressor.compress(line.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def open_dump(path, mode="r"):
+    """Files ending in .gz are compressed"""
+    if str(path).endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def write_dump(client, path):
+    """Writes the library to `path`. Returns the number of images"""
+    count = 0
+    with open_dump(path, "w") as file:
+        for line in to_ndjson(export_images(client)):
+            file.write(line)
+            count += 1
+    return count
+
+
+def read_dump(path):
+    with open_dump(path) as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def import_images(client, records, batch_size=settings.BULK_BATCH_SIZE):
+    """
+    Inserts the images through the bulk path of DBClient.dump_unclassified,
+    one transaction per `batch_size` images. The images already in the DB
+    (same name) are skipped so an interrupted import can be run again.
+    Returns the images imported and skipped
+    """
+    imported = skipped = 0
+    for batch in chunked(records, batch_size):
+        existing = set()
+        for names in chunked([record["name"] for record in batch], IN_LIMIT):
+            existing.update(
+                client.session.execute(select(Image.name).where(Image.name.in_(names))).scalars()
+            )
+        new = []
+        for record in batch:
+            if record["name"] in existing:
+                continue
+            existing.add(record["name"])
+            for key in DATES:
+                if record.get(key):
+                    record[key] = datetime.fromisoformat(record[key])
+            new.append(record)
+        if new:
+            client.dump_unclassified(new, batch_size)
+        client.remove()
+        imported += len(new)
+        skipped += len(batch) - len(new)
+    return imported, skipped
@@ -0,0 +1,98 @@
+"""
+Bounded LRU cache, with a time to live, for the results and the rendered
+fragments of the views. Every write to the tags or the images bumps the
+generation and the entries of the older ones are misses.
+
+Like the tag index it lives in the process; writes made by another process
+show up when the entries expire.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+from rp_tagger.conf import settings
+from rp_tagger.log import logged
+
+
+@logged
+class QueryCache:
+    def __init__(self, max_entries=settings.QUERY_CACHE_SIZE, ttl=settings.QUERY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            # key -> (generation, expires at, value)
+            self.entries = OrderedDict()
+            self.generation = 0
+            self.stats = {
+                "hits": 0,
+                "misses": 0,
+                "evictions": 0,
+                "expired": 0,
+                "invalidations": 0,
+            }
+
+    def invalidate(self):
+        """Everything cached so far is stale"""
+        with self.lock:
+            self.generation += 1
+            self.stats["invalidations"] += 1
+            # the old entries would be misses anyway
+            self.entries.clear()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return default
+            generation, expires, value = entry
+            if generation != self.generation or expires < time.monotonic():
+                del self.entries[key]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return default
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        """
+        `generation` is the one the value was computed in, a value computed
+        before an invalidation is not stored
+        """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = (self.generation, time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def get_or_set(self, key, func):
+        """The cached value of `key` or the result of `func`, which is cached"""
+        missing = object()
+        generation = self.generation
+        value = self.get(key, missing)
+        if value is missing:
+            value = func()
+            self.set(key, value, generation)
+        return value
+
+    def status(self):
+        with self.lock:
+            status = dict(self.stats)
+            status["entries"] = len(self.entries)
+            status["generation"] = self.generation
+        lookups = status["hits"] + status["misses"]
+        status["hit_rate"] = status["hits"] / lookups if lookups else None
+        status["max_entries"] = self.max_entries
+        status["ttl"] = self.ttl
+        return status
+
+
+query_cache = QueryCache() if settings.QUERY_CACHE else None
@@ -15,6 +15,90 @@ DEBUG = False
 ACCEPT = ["*.png", "*.jpg", "*.gif", "*.webm", "*.jpeg", "*.webp"]
 DELETE_ORIGINAL = True
 
+# Ingestion
+INGEST_POLL_INTERVAL = 30 # seconds between scans of IMAGES_FROM_DIR
+INGEST_QUEUE_SIZE = 1000
+INGEST_BATCH_SIZE = 100
+INGEST_WORKERS = os.cpu_count() or 4
+INGEST_POOL = "thread" # or "process"
+# how the files are placed in the library when DELETE_ORIGINAL is False.
+# "copy", "hardlink" or "reflink"
+INGEST_TRANSFER = "copy"
+SCAN_MANIFEST = BASE_DIR / "db" / "scan_manifest.json"
+# near duplicates (re-encoded, resized...) by perceptual hash, needs Pillow.
+# see rp_tagger.phash
+PHASH_DISTANCE = 4 # max different bits of 64
+PHASH_INDEX_PARTS = 4
+PHASH_SKIP_DUPLICATES = False # only count them
+
+# Export of the tree to IMAGES_DIR, see rp_tagger.export
+# "copy", "reflink", "hardlink" or "symlink". A reflink shares the blocks of
+# the library file until one of them is written. With "hardlink" and
+# "symlink" the exported tree IS the library: treat it as read only, an edit
+# there changes the file its content hash names and breaks the duplicate
+# detection
+EXPORT_MODE = "copy"
+EXPORT_WORKERS = 8
+EXPORT_MANIFEST = BASE_DIR / "db" / "export_manifest.json"
+
+# Library files, see rp_tagger.media. Their names don't change with them
+MEDIA_MAX_AGE = 365 * 24 * 60 * 60
+# let the front server send the files: None, "x-sendfile" or "x-accel-redirect"
+MEDIA_SENDFILE = None
+MEDIA_ACCEL_PREFIX = "/_media/" # internal location of UNCLS_IMAGES_DIR in nginx
+
+# Background jobs (tree export, auto tagging, re-scans), see rp_tagger.jobs
+JOB_WORKERS = 2 # jobs running at the same time, the rest wait
+JOB_HISTORY = 50 # finished jobs kept for /jobs
+
+# Auto tagging
+AUTOTAG_BATCH_SIZE = 32 # images per forward pass
+AUTOTAG_THRESHOLD = 0.5
+# processes decoding the images for the model, 0 to do it in the same one
+AUTOTAG_DECODE_WORKERS = max((os.cpu_count() or 2) - 1, 1)
+AUTOTAG_DECODE_POOL = "process" # or "thread"
+AUTOTAG_PREFETCH = 4 # batches decoded ahead
+# background jobs, see rp_tagger.autotag.AutotagJobs. Every worker loads
+# its own model and gets AUTOTAG_JOB_THREADS tensorflow threads
+AUTOTAG_JOB_WORKERS = max((os.cpu_count() or 4) // 4, 1)
+AUTOTAG_JOB_THREADS = max((os.cpu_count() or 4) // AUTOTAG_JOB_WORKERS, 1)
+# the job workers decode in threads, they are daemons and can't start
+# processes. The decoding is mostly tensorflow ops, they release the GIL
+AUTOTAG_JOB_DECODE_WORKERS = 2 # 0 to decode in the worker
+AUTOTAG_CHUNK_SIZE = 256 # images per unit of work
+# keep the scores of the model by content hash so an image isn't scored
+# twice. Only the top AUTOTAG_CACHE_TOP_K over AUTOTAG_CACHE_MIN_SCORE are
+# kept, thresholds lower than that need the model again
+AUTOTAG_CACHE = True
+AUTOTAG_CACHE_TOP_K = 128
+AUTOTAG_CACHE_MIN_SCORE = 0.05
+
+# Database
+DB_POOL_SIZE = 5
+# set on every new connection, see rp_tagger.db.make_engine
+SQLITE_PRAGMAS = {
+    # readers don't block the writer and the other way around
+    "journal_mode": "wal",
+    # WAL is still consistent after a crash with this
+    "synchronous": "normal",
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024, # KiB
+    "busy_timeout": 5000, # ms
+}
+BULK_BATCH_SIZE = 5000 # rows per executemany
+DUMP_BATCH_SIZE = 1000 # rows fetched at a time by the NDJSON export
+# hits are written in batches, see rp_tagger.counters
+HITS_FLUSH_INTERVAL = 5 # seconds
+HITS_MAX_PENDING = 1000
+# keep an in-memory index of the tags for searches (see rp_tagger.index)
+TAG_INDEX = True
+# tags per tag looked at for the suggestions of /classify
+SUGGEST_ROW_SIZE = 100
+# cache of the results and fragments of the views (see rp_tagger.cache)
+QUERY_CACHE = True
+QUERY_CACHE_SIZE = 512 # entries
+QUERY_CACHE_TTL = 30 # seconds, the hits keep changing the order
+
 # Logging
 LOGGERS = {
     "version": 1,
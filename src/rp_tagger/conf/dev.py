@@ -9,6 +9,9 @@ UNCLS_IMAGES_DIR = BASE_DIR / "static" / "__debug__"
 # Config
 DEBUG = True
 DELETE_ORIGINAL = False
+INGEST_POLL_INTERVAL = 2
+SCAN_MANIFEST = TEST_DIR / "scan_manifest.json"
+EXPORT_MANIFEST = TEST_DIR / "export_manifest.json"
 
 # Database
 DATABASES = {
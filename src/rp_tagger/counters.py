@@ -0,0 +1,121 @@
+"""
+Write-behind buffer for the hit counters of the images and tags
+"""
+import time
+import atexit
+import threading
+from collections import Counter
+
+from rp_tagger.conf import settings
+from rp_tagger.log import logged
+
+
+@logged
+class HitBuffer:
+    """
+    Adds up the hits in memory and writes them in one transaction every
+    `flush_interval` seconds or as soon as `max_pending` hits are waiting.
+    `client_factory` builds the DBClient used to write, the flushing thread
+    gets its own.
+    """
+
+    def __init__(
+        self,
+        client_factory,
+        flush_interval=settings.HITS_FLUSH_INTERVAL,
+        max_pending=settings.HITS_MAX_PENDING,
+    ):
+        self.client_factory = client_factory
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self.images = Counter()
+        self.tags = Counter()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._client = None
+
+        self.stats = {
+            "flushed": 0,
+            "last_flush_at": None,
+            "last_flush_duration": None,
+        }
+
+    @property
+    def pending(self):
+        with self._lock:
+            return sum(self.images.values()) + sum(self.tags.values())
+
+    def touch_image(self, id, amount=1):
+        with self._lock:
+            self.images[id] += amount
+        self._check_size()
+
+    def touch_tag(self, name, amount=1):
+        with self._lock:
+            self.tags[name] += amount
+        self._check_size()
+
+    def _check_size(self):
+        if self.pending >= self.max_pending:
+            self._wake.set()
+
+    def status(self):
+        status = dict(self.stats)
+        status["pending"] = self.pending
+        status["running"] = self._thread is not None and self._thread.is_alive()
+        return status
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                images, self.images = self.images, Counter()
+                tags, self.tags = self.tags, Counter()
+            if not images and not tags:
+                return
+
+            start = time.monotonic()
+            if self._client is None:
+                self._client = self.client_factory()
+            try:
+                self._client.flush_hits(images, tags)
+            except Exception:
+                # give them back, they'll go with the next flush
+                with self._lock:
+                    self.images.update(images)
+                    self.tags.update(tags)
+                raise
+            finally:
+                self._client.remove()
+
+            self.stats["flushed"] += sum(images.values()) + sum(tags.values())
+            self.stats["last_flush_at"] = time.time()
+            self.stats["last_flush_duration"] = time.monotonic() - start
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="hit-buffer", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        # whatever is left
+        self.flush()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.logger.exception("Couldn't flush %d hits", self.pending)
@@ -4,14 +4,19 @@ ORM layer for the DB
 import functools
 from datetime import datetime
 
+import sqlite3
+
 from sqlalchemy.orm import declarative_base, relationship
-from sqlalchemy import Column, Table
-from sqlalchemy import create_engine
+from sqlalchemy import Column, Table, Index
+from sqlalchemy import create_engine, event, table, column, DDL
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
 from sqlalchemy import (
     Boolean,
     DateTime,
     Integer,
     Float,
+    LargeBinary,
     String,
     Text,
     ForeignKey
@@ -26,8 +31,11 @@ Base = declarative_base()
 tag_relationship = Table(
     "assoc_tagged_image",
     Base.metadata,
-    Column("image_id", Integer, ForeignKey("image.id"), nullable=False),
-    Column("tag_id", Integer, ForeignKey("tag.id"), nullable=False),
+    Column("image_id", Integer, ForeignKey("image.id"), primary_key=True),
+    Column("tag_id", Integer, ForeignKey("tag.id"), primary_key=True),
+    # tag -> images. The primary key covers image -> tags
+    Index("ix_assoc_tagged_image_tag_id_image_id", "tag_id", "image_id"),
+    sqlite_with_rowid=False,
 )
 
 class Tag(Base):
@@ -39,6 +47,8 @@ class Tag(Base):
     id = Column(Integer, primary_key=True, nullable=False)
     name = Column(String, index=True, nullable=False)
     hits = Column(Integer, index=True, nullable=False, default=0)
+    # number of images with this tag
+    usage_count = Column(Integer, index=True, nullable=False, default=0)
 
     def __str__(self):
         return self.name
@@ -47,7 +57,8 @@ class Tag(Base):
         return {
             "id": self.id,
             "name": self.name,
-            "hits": self.hits
+            "hits": self.hits,
+            "usage_count": self.usage_count,
         }
 
 class Image(Base):
@@ -62,9 +73,23 @@ class Image(Base):
     path = Column(String, nullable=False)
     hits = Column(Integer, nullable=False, default=0)
     last_used = Column(DateTime, default=None, index=True)
+    # number of tags of the image
+    tag_count = Column(Integer, index=True, nullable=False, default=0)
+
+    # duplicate detection
+    size = Column(Integer, index=True)
+    quick_hash = Column(String)
+    content_hash = Column(String, index=True)
+    # dHash for near duplicates, see rp_tagger.phash
+    phash = Column(Integer)
+    # the file couldn't be hashed, hash_missing doesn't try it again
+    phash_failed = Column(Boolean, nullable=False, default=False)
 
     tags = relationship("Tag", secondary=tag_relationship, backref="images")
 
+    # keyset pagination, see DBClient.get_paginated_result
+    __table_args__ = (Index("ix_image_hits_id", "hits", "id"),)
+
     date_created = Column(DateTime, default=datetime.now(), index=True, nullable=False)
 
     def as_dict(self):
@@ -74,14 +99,169 @@ class Image(Base):
             "path": self.path,
             "hits": self.hits,
             "last_used": self.last_used,
+            "content_hash": self.content_hash,
             "tags": [tag.as_dict() for tag in self.tags],
             "date_created": self.date_created,
         }
 
+class AutotagJob(Base):
+    """
+    An auto tagging run over the untagged images. The work is split in
+    AutotagChunks, see rp_tagger.autotag
+    """
+
+    __tablename__ = "autotag_job"
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    # pending, running, done, cancelled or failed
+    status = Column(String, index=True, nullable=False, default="pending")
+    # images to tag when the job was created
+    total = Column(Integer, nullable=False, default=0)
+    threshold = Column(Float)
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+    # last time the workers were started, for the ETA
+    resumed_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+    chunks = relationship("AutotagChunk", backref="job", cascade="all, delete-orphan")
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "total": self.total,
+            "threshold": self.threshold,
+            "created_at": self.created_at,
+            "resumed_at": self.resumed_at,
+            "finished_at": self.finished_at,
+        }
+
+class AutotagChunk(Base):
+    """
+    The untagged images with ids between start_id and end_id, both included
+    """
+
+    __tablename__ = "autotag_chunk"
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    job_id = Column(Integer, ForeignKey("autotag_job.id"), nullable=False)
+    start_id = Column(Integer, nullable=False)
+    end_id = Column(Integer, nullable=False)
+    # pending, running, done or failed
+    status = Column(String, nullable=False, default="pending")
+    images = Column(Integer, nullable=False, default=0)
+    tagged = Column(Integer, nullable=False, default=0)
+    # the process working on it
+    worker = Column(String)
+    claimed_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    error = Column(Text)
+    # seconds per stage of rp_tagger.autotag.AutoTagger, for /status/autotag
+    decode_seconds = Column(Float)
+    wait_seconds = Column(Float)
+    inference_seconds = Column(Float)
+    write_seconds = Column(Float)
+    # scores found in the cache and unreadable images
+    cached = Column(Integer)
+    skipped = Column(Integer)
+
+    __table_args__ = (Index("ix_autotag_chunk_job_id_status", "job_id", "status"),)
+
+class InferenceScore(Base):
+    """
+    What the model said about the image with `content_hash`. `model` is the
+    fingerprint of the model and its tags, `scores` the top scores packed,
+    see rp_tagger.autotag.ScoreCache
+    """
+
+    __tablename__ = "inference_score"
+
+    content_hash = Column(String, primary_key=True, nullable=False)
+    model = Column(String, primary_key=True, nullable=False)
+    scores = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+
+# Trigram index over tag.name so "LIKE '%name%'" doesn't scan the whole table.
+# It's an external content table, the triggers keep it in sync with `tag`.
+tag_fts = table("tag_fts", column("rowid"), column("name"))
+
+TAG_FTS_DDL = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS tag_fts USING fts5(
+        name, content='tag', content_rowid='id', tokenize='trigram'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS tag_fts_ai AFTER INSERT ON tag BEGIN
+        INSERT INTO tag_fts(rowid, name) VALUES (new.id, new.name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS tag_fts_ad AFTER DELETE ON tag BEGIN
+        INSERT INTO tag_fts(tag_fts, rowid, name) VALUES ('delete', old.id, old.name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS tag_fts_au AFTER UPDATE OF name ON tag BEGIN
+        INSERT INTO tag_fts(tag_fts, rowid, name) VALUES ('delete', old.id, old.name);
+        INSERT INTO tag_fts(rowid, name) VALUES (new.id, new.name);
+    END""",
+    "INSERT INTO tag_fts(tag_fts) VALUES ('rebuild')",
+)
+
+# the trigram tokenizer was added in 3.34
+HAS_TRIGRAM = sqlite3.sqlite_version_info >= (3, 34, 0)
+
+
+def create_tag_fts(bind):
+    """Creates (or rebuilds) the trigram index of the tags"""
+    if not HAS_TRIGRAM or bind.dialect.name != "sqlite":
+        return
+    for statement in TAG_FTS_DDL:
+        bind.execute(DDL(statement))
+
+
+@event.listens_for(Tag.__table__, "after_create")
+def _create_tag_fts(target, connection, **kw):
+    create_tag_fts(connection)
+
+
+event.listen(
+    Tag.__table__,
+    "before_drop",
+    DDL("DROP TABLE IF EXISTS tag_fts").execute_if(dialect="sqlite"),
+)
+
+
+def set_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in pragmas.items():
+        # pragmas don't take parameters
+        cursor.execute(f"PRAGMA {pragma} = {value}")
+    cursor.close()
+
+
+def make_engine(name, pool_size=settings.DB_POOL_SIZE, pragmas=settings.SQLITE_PRAGMAS):
+    """
+    Engine with a pool of `pool_size` connections shared by the threads.
+    Every new sqlite connection gets `pragmas`.
+    """
+    url = make_url(name)
+    if url.get_backend_name() != "sqlite" or url.database in (None, "", ":memory:"):
+        return create_engine(name)
+
+    engine = create_engine(
+        name,
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        # the connections go from thread to thread through the pool
+        connect_args={"check_same_thread": False},
+    )
+    event.listen(
+        engine, "connect", lambda dbapi_connection, record: set_pragmas(dbapi_connection, pragmas)
+    )
+    return engine
+
+
 def create_db(name="sqlite:///./db.sqlite"):
-    engine = create_engine(name)
+    """Creates the DB or brings it up to date"""
+    from rp_tagger.migrations import migrate
 
-    Base.metadata.create_all(engine)
+    engine = make_engine(name)
+    migrate(engine)
 
     return engine
 
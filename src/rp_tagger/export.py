@@ -0,0 +1,206 @@
+"""
+Incremental export of the tree to IMAGES_DIR
+"""
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from sqlalchemy import select
+
+from rp_tagger.api import IN_LIMIT, chunked
+from rp_tagger.conf import settings
+from rp_tagger.db import Image, Tag
+from rp_tagger.ingest import transfer_file
+from rp_tagger.log import logged
+
+
+@logged
+class Exporter:
+    """
+    Puts the images of every (tag ids, image ids) group in `dest`/tag/tag/.
+    `mode` is how the files get there (see ingest.transfer_file).
+
+    What was exported is remembered in the manifest at `manifest_path` so
+    the next export only adds, moves or removes what changed. Files whose
+    source changed (another content hash) are exported again.
+    """
+
+    VERSION = 1
+
+    def __init__(
+        self,
+        dest=settings.IMAGES_DIR,
+        mode=settings.EXPORT_MODE,
+        workers=settings.EXPORT_WORKERS,
+        manifest_path=settings.EXPORT_MANIFEST,
+    ):
+        self.dest = Path(dest)
+        self.mode = mode
+        self.workers = workers
+        self.manifest_path = manifest_path and Path(manifest_path)
+        # relative path -> [source path, content hash]
+        self.files = {}
+        self.load()
+
+    def load(self):
+        if not self.manifest_path or not self.manifest_path.exists():
+            return
+        try:
+            with open(self.manifest_path) as file:
+                manifest = json.load(file)
+        except ValueError:
+            self.logger.warning("Corrupted export manifest %s. Exporting everything", self.manifest_path)
+            return
+        if (
+            manifest.get("version") == self.VERSION
+            and manifest.get("dest") == str(self.dest)
+            # the files have to be placed again
+            and manifest.get("mode") == self.mode
+        ):
+            self.files = manifest["files"]
+
+    def save(self):
+        if not self.manifest_path:
+            return
+        tmp = self.manifest_path.with_suffix(".tmp")
+        with open(tmp, "w") as file:
+            json.dump(
+                {"version": self.VERSION, "dest": str(self.dest), "mode": self.mode, "files": self.files},
+                file,
+            )
+        os.replace(tmp, self.manifest_path)
+
+    def resolve(self, client, groups):
+        """{relative path: [source path, content hash]} of the groups"""
+        groups = list(groups)
+        tag_ids = {tag for path, _ in groups for tag in path}
+        image_ids = [id for _, ids in groups for id in ids]
+
+        names = {}
+        for chunk in chunked(tag_ids, IN_LIMIT):
+            names.update(client.session.execute(select(Tag.id, Tag.name).where(Tag.id.in_(chunk))).all())
+        images = {}
+        for chunk in chunked(image_ids, IN_LIMIT):
+            rows = client.session.execute(
+                select(Image.id, Image.name, Image.path, Image.content_hash).where(
+                    Image.id.in_(chunk)
+                )
+            )
+            images.update((row.id, row) for row in rows)
+
+        files = {}
+        for path, ids in groups:
+            folder = os.path.join(*(names[tag] for tag in path)) if path else ""
+            for id in ids:
+                image = images[id]
+                files[os.path.join(folder, image.name)] = [image.path, image.content_hash]
+        return files
+
+    def export(self, client, groups, prune=True, progress=None):
+        """
+        Exports the groups. With `prune` the files of previous exports that
+        are not in the groups are removed. `progress(done, total)` is called
+        as the files are placed. Returns what was done
+        """
+        start = time.monotonic()
+        wanted = self.resolve(client, groups)
+
+        added = {path: src for path, src in wanted.items() if self.files.get(path) != src}
+        removed = {
+            path: src
+            for path, src in self.files.items()
+            if path not in wanted and prune or path in added
+        }
+        # same file, another folder
+        by_source = {tuple(src): path for path, src in removed.items() if path not in wanted}
+        moved = {}
+        for path, src in list(added.items()):
+            old = by_source.pop(tuple(src), None)
+            if old is not None:
+                moved[old] = path
+                del added[path]
+                del removed[old]
+
+        stats = {
+            "added": len(added),
+            "moved": len(moved),
+            "removed": len(removed),
+            "unchanged": len(wanted) - len(added) - len(moved),
+            "errors": 0,
+        }
+        self.logger.info("Exporting to %s. %s", self.dest, stats)
+
+        for folder in {os.path.dirname(path) for path in list(added) + list(moved.values())}:
+            os.makedirs(self.dest / folder, exist_ok=True)
+
+        total = len(removed) + len(moved) + len(added)
+        done = 0
+        with ThreadPoolExecutor(self.workers) as pool:
+            # the removed files can be where the others go
+            for path, error in zip(removed, pool.map(self._remove, removed)):
+                if error is None:
+                    self.files.pop(path, None)
+                else:
+                    self._failed(stats, path, error)
+                done += 1
+                if progress is not None:
+                    progress(done, total)
+            for (old, path), error in zip(moved.items(), pool.map(self._move, moved, moved.values())):
+                if error is None:
+                    self.files[path] = self.files.pop(old)
+                else:
+                    self._failed(stats, path, error)
+                done += 1
+                if progress is not None:
+                    progress(done, total)
+            for (path, src), error in zip(added.items(), pool.map(self._add, added, added.values())):
+                if error is None:
+                    self.files[path] = src
+                else:
+                    self._failed(stats, path, error)
+                done += 1
+                if progress is not None:
+                    progress(done, total)
+
+        self._remove_empty({os.path.dirname(path) for path in list(removed) + list(moved)})
+        self.save()
+        stats["seconds"] = time.monotonic() - start
+        self.logger.info("Exported to %s in %.2fs", self.dest, stats["seconds"])
+        return stats
+
+    def _failed(self, stats, path, error):
+        stats["errors"] += 1
+        self.logger.error("Couldn't export %s: %s", path, error)
+
+    def _add(self, path, src):
+        try:
+            transfer_file(src[0], self.dest / path, self.mode)
+        except OSError as exc:
+            return exc
+
+    def _move(self, old, path):
+        try:
+            os.replace(self.dest / old, self.dest / path)
+        except OSError as exc:
+            return exc
+
+    def _remove(self, path):
+        try:
+            os.remove(self.dest / path)
+        except FileNotFoundError:
+            pass
+        except OSError as exc:
+            return exc
+
+    def _remove_empty(self, folders):
+        """Removes the folders left empty, and their parents"""
+        for folder in sorted(folders, key=len, reverse=True):
+            while folder:
+                try:
+                    os.rmdir(self.dest / folder)
+                except OSError:
+                    # not empty or already gone
+                    break
+                folder = os.path.dirname(folder)
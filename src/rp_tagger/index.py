@@ -0,0 +1,270 @@
+"""
+In-memory inverted index of the tags. Every tag has a bitmap (a python int)
+of the ids of the images tagged with it so a search is a handful of ANDs
+instead of one INTERSECT per tag.
+
+It also counts how many images every pair of tags shares, for the tag
+suggestions of `suggest`.
+
+The index lives in the process that loaded it; writes made by another
+process won't show up until it's loaded again.
+"""
+import heapq
+import string
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter
+
+from sqlalchemy import select
+
+from rp_tagger.conf import settings
+from rp_tagger.db import Tag, Image, tag_relationship
+from rp_tagger.log import logged
+
+
+def popcount(bits):
+    return bin(bits).count("1")
+
+
+# python 3.10+
+popcount = getattr(int, "bit_count", popcount)
+
+# LIKE only ignores the case of the ASCII letters
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def to_bitmap(ids):
+    ids = list(ids)
+    if not ids:
+        return 0
+    buf = bytearray(max(ids) // 8 + 1)
+    for id in ids:
+        buf[id >> 3] |= 1 << (id & 7)
+    return int.from_bytes(buf, "little")
+
+
+def iter_bits(bits):
+    """Positions of the bits set, in ascending order"""
+    reverse = bin(bits)[:1:-1]
+    pos = reverse.find("1")
+    while pos != -1:
+        yield pos
+        pos = reverse.find("1", pos + 1)
+
+
+@logged
+class TagIndex:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.loaded = False
+            # tag name -> bitmap of image ids
+            self.postings = {}
+            # image id -> tag names
+            self.image_tags = {}
+            # image id -> hits
+            self.hits = {}
+            # tag name -> images with it
+            self.counts = Counter()
+            # tag name -> Counter of the tags it shares images with
+            self.cooccurrences = {}
+            # tag name -> the first `SUGGEST_ROW_SIZE` of its cooccurrences,
+            # built when needed
+            self._rows = {}
+            # bumped when the tags of an image change, not by the hits
+            self.version = 0
+            # (terms, version, bitmap, sorted keys) of the last search
+            self._last_search = None
+
+    def load(self, session):
+        with self.lock:
+            self.reset()
+            for id, hits in session.execute(select(Image.id, Image.hits)):
+                self.image_tags[id] = set()
+                self.hits[id] = hits or 0
+            rows = session.execute(
+                select(Tag.name, tag_relationship.c.image_id).join(
+                    tag_relationship, Tag.id == tag_relationship.c.tag_id
+                )
+            )
+            ids = {}
+            for name, image_id in rows:
+                ids.setdefault(name, []).append(image_id)
+                self.image_tags[image_id].add(name)
+            self.postings = {name: to_bitmap(tagged) for name, tagged in ids.items()}
+            self.counts = Counter({name: len(tagged) for name, tagged in ids.items()})
+            self._load_cooccurrences()
+            self.loaded = True
+        self.logger.info(
+            "Loaded index of %d images and %d tags", len(self.hits), len(self.postings)
+        )
+
+    def _load_cooccurrences(self):
+        cooccurrences = {}
+        for tags in self.image_tags.values():
+            for name in tags:
+                row = cooccurrences.get(name)
+                if row is None:
+                    row = cooccurrences[name] = Counter()
+                # Counter.update runs in C, the tag itself is removed below
+                row.update(tags)
+        for name, row in cooccurrences.items():
+            del row[name]
+        self.cooccurrences = cooccurrences
+
+    def add(self, image_id, tags, hits=0):
+        with self.lock:
+            self.hits[image_id] = hits
+            self.image_tags[image_id] = set()
+            self._set_tags(image_id, tags)
+
+    def update(self, image_id, tags):
+        with self.lock:
+            if image_id not in self.hits:
+                self.add(image_id, tags)
+            else:
+                self._set_tags(image_id, tags)
+
+    def remove(self, image_id):
+        with self.lock:
+            self._set_tags(image_id, ())
+            self.image_tags.pop(image_id, None)
+            self.hits.pop(image_id, None)
+
+    def remove_tag(self, name):
+        with self.lock:
+            bits = self.postings.pop(name, 0)
+            for image_id in iter_bits(bits):
+                self.image_tags[image_id].discard(name)
+            self.counts.pop(name, None)
+            self._rows.pop(name, None)
+            for other in self.cooccurrences.pop(name, ()):
+                self.cooccurrences[other].pop(name, None)
+                self._rows.pop(other, None)
+            self.version += 1
+
+    def touch(self, image_id, amount=1):
+        with self.lock:
+            if image_id not in self.hits:
+                return
+            old = (-self.hits[image_id], -image_id)
+            self.hits[image_id] += amount
+            if self._last_search and self._last_search[2] >> image_id & 1:
+                # moved in the last result instead of sorting all of it again
+                keys = self._last_search[3]
+                del keys[bisect_left(keys, old)]
+                insort(keys, (-self.hits[image_id], -image_id))
+
+    def _set_tags(self, image_id, tags):
+        old = self.image_tags.get(image_id, set())
+        new = set(tags)
+        bit = 1 << image_id
+        for name in old - new:
+            bits = self.postings[name] & ~bit
+            if bits:
+                self.postings[name] = bits
+            else:
+                del self.postings[name]
+        for name in new - old:
+            self.postings[name] = self.postings.get(name, 0) | bit
+        if image_id in self.image_tags:
+            self.image_tags[image_id] = new
+        for name in old - new:
+            self.counts[name] -= 1
+            if not self.counts[name]:
+                del self.counts[name]
+        self.counts.update(new - old)
+        self._pairs(old, old - new, -1)
+        self._pairs(new, new - old, 1)
+        self.version += 1
+
+    def _pairs(self, tags, changed, amount):
+        """Adds `amount` to the pairs of `tags` with a tag in `changed`"""
+        for name in tags:
+            others = [other for other in (tags if name in changed else changed) if other != name]
+            if not others:
+                continue
+            row = self.cooccurrences.setdefault(name, Counter())
+            for other in others:
+                row[other] += amount
+                if not row[other]:
+                    del row[other]
+            self._rows.pop(name, None)
+
+    def suggest(self, tags, limit=35, row_size=settings.SUGGEST_ROW_SIZE):
+        """
+        Tags that go with `tags`, most likely first. A tag scores the sum of
+        P(tag | t) over every t in `tags`; only the `row_size` tags that go
+        most with each t are looked at so the cost doesn't grow with the
+        library.
+        """
+        tags = set(tags)
+        scores = Counter()
+        with self.lock:
+            for name in tags:
+                count = self.counts.get(name)
+                if not count:
+                    continue
+                row = self._rows.get(name)
+                if row is None:
+                    row = heapq.nlargest(
+                        row_size,
+                        self.cooccurrences.get(name, {}).items(),
+                        key=lambda item: (item[1], item[0]),
+                    )
+                    self._rows[name] = row
+                for other, shared in row:
+                    if other not in tags:
+                        scores[other] += shared / count
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [name for name, _ in ranked[:limit]]
+
+    def match(self, term):
+        """
+        Bitmap of the images with a tag that contains `term`, the same as
+        rp_tagger.api.match_tags: no wildcards and LIKE's case folding
+        """
+        term = term.translate(ASCII_LOWER)
+        bits = 0
+        for name, posting in self.postings.items():
+            if term in name.translate(ASCII_LOWER):
+                bits |= posting
+        return bits
+
+    def search(self, terms, after=None, limit=None):
+        """
+        Ids of the images matching every term, most hits first. `after` is
+        the (hits, id) of the last image of the previous page.
+        """
+        with self.lock:
+            # touch moves the keys around
+            keys = self._search(terms)
+            start = bisect_right(keys, (-after[0], -after[1])) if after else 0
+            end = start + limit if limit is not None else None
+            return [-id for _, id in keys[start:end]]
+
+    def _search(self, terms):
+        """(-hits, -id) of the matches, sorted"""
+        key = tuple(sorted(set(terms)))
+        with self.lock:
+            if self._last_search and self._last_search[:2] == (key, self.version):
+                return self._last_search[3]
+
+            bitmaps = sorted((self.match(term) for term in key), key=popcount)
+            result = bitmaps[0] if bitmaps else 0
+            # smallest first so it empties as soon as possible
+            for bits in bitmaps[1:]:
+                if not result:
+                    break
+                result &= bits
+
+            hits = self.hits
+            keys = sorted((-hits[id], -id) for id in iter_bits(result))
+            self._last_search = (key, self.version, result, keys)
+        return keys
+
+
+tag_index = TagIndex() if settings.TAG_INDEX else None
@@ -0,0 +1,453 @@
+"""
+Background ingestion of new files from IMAGES_FROM_DIR
+"""
+import os
+import time
+import errno
+import fcntl
+import hashlib
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+from queue import Queue, Empty
+
+from rp_tagger.api import DBClient, chunked
+from rp_tagger.conf import settings
+from rp_tagger.log import logged
+from rp_tagger.phash import PHashIndex, dhash
+from rp_tagger.scan import Scanner, walk_images
+
+HASH_DELM = "__"
+
+UNCLS_IMAGES_DIR = settings.UNCLS_IMAGES_DIR
+
+CHUNK_SIZE = 1024 * 1024
+EDGE_SIZE = 64 * 1024
+
+# linux/fs.h
+FICLONE = 0x40049409
+
+POOLS = {"thread": ThreadPoolExecutor, "process": ProcessPoolExecutor}
+
+
+def quick_hash(path, size):
+    """Hash of the first and last EDGE_SIZE bytes"""
+    digest = hashlib.md5()
+    with open(path, "rb") as infile:
+        digest.update(infile.read(EDGE_SIZE))
+        if size > EDGE_SIZE:
+            infile.seek(max(EDGE_SIZE, size - EDGE_SIZE))
+            digest.update(infile.read(EDGE_SIZE))
+    return digest.hexdigest()
+
+
+def content_hash(path):
+    """md5 of the whole file, read in chunks"""
+    digest = hashlib.md5()
+    with open(path, "rb") as infile:
+        for chunk in iter(lambda: infile.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def probe_image(image):
+    """Size and hash of the edges, enough to tell apart most files"""
+    path = image["path"]
+    try:
+        size = os.stat(path).st_size
+        return dict(image, size=size, quick_hash=quick_hash(path, size))
+    except OSError as exc:
+        # deleted or moved since the scan
+        return dict(image, error=exc)
+
+
+def hash_image(image, phash=True):
+    """Hash of the whole file and, with `phash`, the perceptual hash"""
+    try:
+        image = dict(image, content_hash=content_hash(image["path"]))
+    except OSError as exc:
+        return dict(image, error=exc)
+    if phash:
+        image["phash"] = dhash(image["path"])
+    return image
+
+
+def copy_file(src, dst):
+    """Copies the file in kernel space if possible"""
+    try:
+        with open(src, "rb") as infile, open(dst, "wb") as outfile:
+            remaining = os.fstat(infile.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(infile.fileno(), outfile.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+            return
+    except (AttributeError, OSError):
+        # old kernel or different filesystems.
+        pass
+    # uses sendfile on linux
+    shutil.copyfile(src, dst)
+
+
+def reflink_file(src, dst):
+    with open(src, "rb") as infile, open(dst, "wb") as outfile:
+        fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+
+
+def transfer_file(src, dst, mode):
+    """
+    Puts the file in the library folder. mode is one of "move", "copy",
+    "hardlink", "reflink" or "symlink"; hardlink and reflink fall back to a
+    copy when the source and the destination are not in the same filesystem
+    (or it doesn't support reflinks).
+    """
+    if mode == "move":
+        try:
+            os.rename(src, dst)
+        except OSError as exc:
+            if exc.errno != errno.EXDEV:
+                raise
+            copy_file(src, dst)
+            os.remove(src)
+        return
+    if mode == "symlink":
+        if os.path.lexists(dst):
+            os.remove(dst)
+        os.symlink(os.path.abspath(src), dst)
+        return
+    if mode == "hardlink":
+        try:
+            if os.path.exists(dst):
+                os.remove(dst)
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    elif mode == "reflink":
+        try:
+            reflink_file(src, dst)
+            return
+        except OSError:
+            pass
+    copy_file(src, dst)
+
+
+def _transfer(src, dst, mode):
+    try:
+        transfer_file(src, dst, mode)
+    except OSError as exc:
+        return exc
+
+
+@logged
+class Ingestor:
+    """
+    Scans the source folder every `poll_interval` seconds and feeds the new
+    files to a writer thread through a bounded queue. The writer owns its own
+    DB session so the request handlers only have to read from the database.
+    """
+
+    def __init__(
+        self,
+        path=settings.IMAGES_FROM_DIR,
+        dest=UNCLS_IMAGES_DIR,
+        manifest_path=settings.SCAN_MANIFEST,
+        poll_interval=settings.INGEST_POLL_INTERVAL,
+        queue_size=settings.INGEST_QUEUE_SIZE,
+        batch_size=settings.INGEST_BATCH_SIZE,
+        workers=settings.INGEST_WORKERS,
+        pool=settings.INGEST_POOL,
+        transfer=settings.INGEST_TRANSFER,
+        phash_distance=settings.PHASH_DISTANCE,
+        skip_near_duplicates=settings.PHASH_SKIP_DUPLICATES,
+    ):
+        self.path = path
+        self.dest = Path(dest)
+        self.scanner = Scanner(path, manifest_path)
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.queue = Queue(maxsize=queue_size)
+        self.transfer = "move" if settings.DELETE_ORIGINAL else transfer
+        self.pool = POOLS[pool](max_workers=workers)
+        # loaded by the writer on its first batch
+        self.phash_index = PHashIndex()
+        self.phash_distance = phash_distance
+        self.skip_near_duplicates = skip_near_duplicates
+
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        # files of the current scan that couldn't be ingested
+        self._failed = set()
+        # the writer thread and the re-scans
+        self._write_lock = threading.Lock()
+
+        self.stats = {
+            "last_scan_at": None,
+            "last_scan_duration": None,
+            "last_scan_files": 0,
+            "files_per_sec": None,
+            "total_ingested": 0,
+            "duplicates": 0,
+            "near_duplicates": 0,
+        }
+
+    @property
+    def running(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._scan_loop, name="ingest-scan", daemon=True),
+            threading.Thread(target=self._write_loop, name="ingest-write", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        self.logger.info("Started ingestion of %s every %ss", self.path, self.poll_interval)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self.pool.shutdown(wait=False)
+
+    def wake(self):
+        """Don't wait for the poll interval to scan again"""
+        self._wake.set()
+
+    def status(self):
+        with self._lock:
+            status = dict(self.stats)
+        status["queue_depth"] = self.queue.qsize()
+        status["queue_size"] = self.queue.maxsize
+        status["poll_interval"] = self.poll_interval
+        status["running"] = self.running
+        return status
+
+    def _scan_loop(self):
+        while not self._stop.is_set():
+            try:
+                self.scan()
+            except Exception:
+                self.logger.exception("Scan of %s failed", self.path)
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def scan(self):
+        """Put every new file on the queue and wait until the writer is done with them"""
+        start = time.monotonic()
+        found = 0
+        with self._lock:
+            self._failed.clear()
+        for image in self.scanner.scan():
+            # blocks when the writer falls behind
+            self.queue.put(image)
+            found += 1
+            if self._stop.is_set():
+                return
+        self.queue.join()
+        # only remember the files once they are in the DB
+        with self._lock:
+            failed, self._failed = self._failed, set()
+        self.scanner.forget(failed)
+        self.scanner.save()
+        duration = time.monotonic() - start
+
+        with self._lock:
+            self.stats["last_scan_at"] = time.time()
+            self.stats["last_scan_duration"] = duration
+            self.stats["last_scan_files"] = found
+            self.stats["files_per_sec"] = found / duration if duration else None
+
+    def _write_loop(self):
+        client = DBClient()
+        while not self._stop.is_set():
+            try:
+                batch = [self.queue.get(timeout=1)]
+            except Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            done = set()
+            try:
+                done = self.write(client, batch)
+            except Exception:
+                self.logger.exception("Failed to ingest %d files", len(batch))
+            finally:
+                # a new session for every batch
+                client.remove()
+                with self._lock:
+                    self._failed.update(
+                        image["path"] for image in batch if image["path"] not in done
+                    )
+                for _ in batch:
+                    self.queue.task_done()
+
+    def rescan(self, client, progress=None):
+        """
+        Goes through every file of the source folder, not only the ones the
+        manifest doesn't know about. The ones already in the DB are skipped
+        as duplicates. `progress(done, total)` is called after every batch.
+        """
+        images = list(walk_images(self.path))
+        done = 0
+        for batch in chunked(images, self.batch_size):
+            try:
+                self.write(client, batch)
+            finally:
+                client.remove()
+            done += len(batch)
+            if progress is not None:
+                progress(done, len(images))
+        return done
+
+    def write(self, client, images):
+        """
+        Ingests the files. Returns the paths of the ones taken care of (new,
+        duplicates or unreadable), not the ones that couldn't be placed. If
+        an insert fails its files are taken out of the library first
+        """
+        ingested = 0
+        failed = set()
+        with self._write_lock:
+            if not self.phash_index.loaded:
+                self.phash_index.load(client.session)
+            for batch in self.gen_img_obj(client, images, failed):
+                try:
+                    ids = client.dump_unclassified(batch)
+                except Exception:
+                    self.undo_transfers(batch)
+                    raise
+                for id, image in zip(ids, batch):
+                    if image.get("phash") is not None:
+                        self.phash_index.add(id, image["phash"])
+                ingested += len(batch)
+        # flush the last image
+        total = client.count_images()
+
+        with self._lock:
+            self.stats["total_ingested"] += ingested
+            self.stats["duplicates"] += len(images) - ingested
+        if ingested:
+            self.logger.info(
+                "Loaded %d new images. There is a total of %d images",
+                ingested,
+                total,
+            )
+        return {image["path"] for image in images} - failed
+
+    def undo_transfers(self, images):
+        """Takes the files of an insert that failed out of the library, the moved ones go back"""
+        for image in images:
+            try:
+                if self.transfer == "move":
+                    transfer_file(image["path"], image["source"], "move")
+                else:
+                    os.remove(image["path"])
+            except OSError as exc:
+                self.logger.error("Couldn't undo the transfer of %s: %s", image["source"], exc)
+
+    def candidates(self, client, image):
+        """
+        Hashes of the whole file of the images in the DB with the same size
+        and edges, the only ones the file can be a duplicate of
+        """
+        return {
+            full
+            for edges, full in client.get_hashes(image["size"])
+            if edges == image["quick_hash"]
+        }
+
+    def is_near_duplicate(self, client, image):
+        """Looks for images that look the same in the perceptual hash index"""
+        if image.get("phash") is None:
+            return False
+        near = self.phash_index.search(image["phash"], self.phash_distance)
+        if near:
+            # deleted since the index was loaded
+            existing = {image.id for image in client.get_images([id for _, id in near])}
+            for _, id in near:
+                if id not in existing:
+                    self.phash_index.remove(id)
+            near = [(dist, id) for dist, id in near if id in existing]
+        if not near:
+            return False
+        with self._lock:
+            self.stats["near_duplicates"] += 1
+        self.logger.info(
+            "%s looks like the images %s (distance %d)",
+            image["path"],
+            [id for _, id in near],
+            near[0][0],
+        )
+        return True
+
+    def gen_img_obj(self, client, images, failed):
+        """
+        Yields, in order, batches of new images already placed in the library
+        folder, "source" is where they were. Hashing and copying happen in
+        the pool, this thread only talks to the DB. The paths of the files that couldn't be placed are
+        added to `failed`.
+        """
+        probed = self.pool.map(probe_image, images)
+        for batch in chunked(probed, self.batch_size):
+            readable = []
+            for image in batch:
+                if "error" in image:
+                    self.logger.error("Couldn't read %s: %s", image["path"], image["error"])
+                    continue
+                readable.append(image)
+            # from cheaper to more expensive: size, hash of the edges, hash
+            # of the whole file. The perceptual hash is only for new files
+            candidates = [self.candidates(client, image) for image in readable]
+            hashed = list(self.pool.map(hash_image, readable, [not found for found in candidates]))
+
+            unique = []
+            seen = set()
+            for image, found in zip(hashed, candidates):
+                if "error" in image:
+                    self.logger.error("Couldn't read %s: %s", image["path"], image["error"])
+                    continue
+                # to avoid duplicates
+                if image["content_hash"] in found or image["content_hash"] in seen:
+                    self.logger.debug("Duplicate found: %s", image["path"])
+                    continue
+                seen.add(image["content_hash"])
+                unique.append(image)
+            # same edges as another file but not the same
+            late = [image for image in unique if "phash" not in image]
+            for image, value in zip(late, self.pool.map(dhash, [image["path"] for image in late])):
+                image["phash"] = value
+
+            new = []
+            for image in unique:
+                if self.is_near_duplicate(client, image) and self.skip_near_duplicates:
+                    continue
+                ext = image["path"].split(".")[-1]
+                image["name"] = HASH_DELM + image["content_hash"] + "." + ext
+                new.append(image)
+
+            sources = [image["path"] for image in new]
+            targets = [str(self.dest / image["name"]) for image in new]
+            done = self.pool.map(_transfer, sources, targets, repeat(self.transfer))
+            placed = []
+            for image, target, error in zip(new, targets, done):
+                if error is not None:
+                    self.logger.error("Couldn't ingest %s: %s", image["path"], error)
+                    failed.add(image["path"])
+                    continue
+                image["source"], image["path"] = image["path"], target
+                placed.append(image)
+            if placed:
+                yield placed
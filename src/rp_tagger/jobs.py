@@ -0,0 +1,180 @@
+"""
+Background jobs for the long operations of the server (tree export, auto
+tagging, re-scans) so they don't block the requests
+"""
+import time
+import threading
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from rp_tagger.conf import settings
+from rp_tagger.log import logged
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    One run of a task. The task reports its progress with `update` and
+    checks `cancelled` (or calls `check`) to stop early.
+    """
+
+    def __init__(self, id, kind, params):
+        self.id = id
+        self.kind = kind
+        self.params = params
+        self.status = "pending"
+        self.progress = None
+        self.message = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future = None
+        self._cancel = threading.Event()
+
+    @property
+    def active(self):
+        return self.status in ("pending", "running")
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+    def update(self, progress=None, message=None):
+        """`progress` goes from 0 to 1"""
+        if progress is not None:
+            self.progress = progress
+        if message is not None:
+            self.message = message
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "params": self.params,
+            "status": self.status,
+            "progress": self.progress,
+            "message": self.message,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+@logged
+class Jobs:
+    """
+    Runs the registered tasks in at most `workers` threads, the jobs past
+    that wait their turn. A task is `func(job, client, **params)`; it runs
+    in its own thread so `client` gives it its own session, which is
+    removed when it's done. There is only one active job of each kind.
+
+    The last `history` finished jobs are kept for the status endpoint.
+    """
+
+    def __init__(self, client, workers=settings.JOB_WORKERS, history=settings.JOB_HISTORY):
+        self.client = client
+        self.workers = workers
+        self.history = history
+        self.tasks = {}
+        self.jobs = OrderedDict()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def register(self, kind, func):
+        self.tasks[kind] = func
+
+    def task(self, kind):
+        """Decorator version of `register`"""
+
+        def decorator(func):
+            self.register(kind, func)
+            return func
+
+        return decorator
+
+    def submit(self, kind, **params):
+        """Queues a job. Returns its id, or the id of the active job of that kind"""
+        if kind not in self.tasks:
+            raise KeyError(f"Unknown job: {kind}")
+        with self._lock:
+            for job in self.jobs.values():
+                if job.kind == kind and job.active:
+                    return job.id
+            job = Job(next(self._ids), kind, params)
+            self.jobs[job.id] = job
+            self._trim()
+            job.future = self.pool.submit(self._run, job)
+        self.logger.info("Job %d (%s) queued", job.id, kind)
+        return job.id
+
+    def get(self, job_id):
+        """The job as a dict. KeyError if there is no such job"""
+        return self.jobs[job_id].as_dict()
+
+    def wait(self, job_id, timeout=None):
+        """Waits for the job to finish. Returns it as a dict"""
+        job = self.jobs[job_id]
+        if not job.future.cancelled():
+            job.future.result(timeout)
+        return job.as_dict()
+
+    def list(self):
+        with self._lock:
+            return [job.as_dict() for job in self.jobs.values()]
+
+    def cancel(self, job_id):
+        """Pending jobs don't run, running ones stop when the task checks"""
+        job = self.jobs[job_id]
+        job._cancel.set()
+        if job.future.cancel():
+            job.status = "cancelled"
+            job.finished_at = time.time()
+
+    def shutdown(self, wait=True):
+        for job in list(self.jobs.values()):
+            if job.active:
+                self.cancel(job.id)
+        self.pool.shutdown(wait=wait)
+
+    def _trim(self):
+        finished = [job.id for job in self.jobs.values() if not job.active]
+        for job_id in finished[: max(len(finished) - self.history, 0)]:
+            del self.jobs[job_id]
+
+    def _run(self, job):
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            job.result = self.tasks[job.kind](job, self.client, **job.params)
+            job.status = "cancelled" if job.cancelled else "done"
+            job.progress = 1.0 if job.status == "done" else job.progress
+        except JobCancelled:
+            job.status = "cancelled"
+        except Exception as exc:
+            self.logger.exception("Job %d (%s) failed", job.id, job.kind)
+            job.status = "failed"
+            job.error = str(exc)
+        finally:
+            job.finished_at = time.time()
+            # the session of this thread
+            self.client.remove()
+        self.logger.info(
+            "Job %d (%s) is %s after %.2fs",
+            job.id,
+            job.kind,
+            job.status,
+            job.finished_at - job.started_at,
+        )
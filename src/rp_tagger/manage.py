@@ -2,7 +2,6 @@ from pathlib import Path
 import os
 import sys
 
-from rp_tagger.db import create_db
 from rp_tagger.conf import settings
 from rp_tagger.test import build_test_db
 
@@ -12,7 +11,62 @@ def get_command(command: list=sys.argv[1]):
         import rp_tagger.test.shell
 
     elif command == "migrate":
-        create_db(settings.DATABASES["default"]["engine"])
+        from rp_tagger.db import make_engine
+        from rp_tagger.migrations import migrate, explain, print_plans
+
+        engine = make_engine(settings.DATABASES["default"]["engine"])
+        if "--explain" in sys.argv:
+            print("Before")
+            print_plans(explain(engine))
+        print("Applied", migrate(engine))
+        if "--explain" in sys.argv:
+            print("After")
+            print_plans(explain(engine))
+
+    elif command == "explain":
+        # the plans of the DB as it is, it isn't migrated
+        from rp_tagger.db import make_engine
+        from rp_tagger.migrations import explain, print_plans
+        print_plans(explain(make_engine(settings.DATABASES["default"]["engine"])))
+
+    elif command == "recount":
+        from rp_tagger.api import DBClient
+        DBClient(index=None).recount()
+
+    elif command == "prune-scores":
+        # the cached scores of other models and of deleted images
+        from rp_tagger.api import DBClient
+        from rp_tagger.autotag import ScoreCache, model_fingerprint
+        print("Deleted", ScoreCache(DBClient(index=None), model_fingerprint()).prune())
+
+    elif command == "export":
+        # manage.py export library.ndjson[.gz]
+        from rp_tagger.api import DBClient
+        from rp_tagger.backup import write_dump
+        print("Exported", write_dump(DBClient(index=None), sys.argv[2]), "images")
+
+    elif command == "import":
+        from rp_tagger.api import DBClient
+        from rp_tagger.backup import import_images, read_dump
+        imported, skipped = import_images(DBClient(index=None), read_dump(sys.argv[2]))
+        print("Imported", imported, "images. Skipped", skipped, "already there")
+
+    elif command == "dedupe":
+        # manage.py dedupe [max distance]
+        from rp_tagger.api import DBClient
+        from rp_tagger.phash import PILImage, find_duplicates, hash_missing
+        client = DBClient(index=None)
+        if PILImage is not None:
+            print("Hashed", hash_missing(client), "images")
+        else:
+            print("Pillow is not installed, only the images already hashed are compared")
+        distance = int(sys.argv[2]) if len(sys.argv) > 2 else settings.PHASH_DISTANCE
+        clusters = find_duplicates(client, distance)
+        for i, cluster in enumerate(clusters, 1):
+            print(f"Cluster {i} ({len(cluster)} images)")
+            for id, path in cluster:
+                print(f"    {id} {path}")
+        print(len(clusters), "clusters of near duplicates,", sum(map(len, clusters)), "images")
 
     elif command == "test":
         from rp_tagger.test import test_unit
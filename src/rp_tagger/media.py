@@ -0,0 +1,76 @@
+"""
+Serving of the library files. Their names have the hash of their content so
+they can be cached forever
+"""
+import os
+import mimetypes
+
+from flask import abort, current_app, request
+from werkzeug.security import safe_join
+from werkzeug.utils import send_from_directory
+
+from rp_tagger.conf import settings
+from rp_tagger.ingest import HASH_DELM
+
+
+def content_etag(name):
+    """The content hash in the name of the library files, None for the others"""
+    if name.startswith(HASH_DELM):
+        return name[len(HASH_DELM) :].split(".")[0]
+    return None
+
+
+def immutable(response, etag, max_age):
+    response.set_etag(etag)
+    # send_file always asks to revalidate
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.immutable = True
+    return response
+
+
+def send_media(
+    directory,
+    name,
+    max_age=settings.MEDIA_MAX_AGE,
+    sendfile=settings.MEDIA_SENDFILE,
+    accel_prefix=settings.MEDIA_ACCEL_PREFIX,
+):
+    """
+    Response for the file `name` of `directory`. If the browser already has
+    it the answer is a 304 and the file is not touched, range requests are
+    answered with the part asked for. `sendfile` hands the transfer to the
+    front server:
+
+        None: the file is sent from here
+        "x-sendfile": X-Sendfile header with the path (apache, lighttpd)
+        "x-accel-redirect": X-Accel-Redirect header with `accel_prefix`/name
+            (nginx, the prefix has to be an internal location)
+    """
+    etag = content_etag(name)
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        return immutable(current_app.response_class(status=304), etag, max_age)
+
+    if sendfile == "x-accel-redirect":
+        path = safe_join(os.fspath(directory), name)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        response = current_app.response_class(
+            mimetype=mimetypes.guess_type(name)[0] or "application/octet-stream"
+        )
+        response.headers["X-Accel-Redirect"] = accel_prefix.rstrip("/") + "/" + name
+    else:
+        response = send_from_directory(
+            directory,
+            name,
+            request.environ,
+            # the mtime and the size of the file for the others
+            etag=etag or True,
+            conditional=True,
+            use_x_sendfile=sendfile == "x-sendfile",
+            response_class=current_app.response_class,
+        )
+    if etag is not None and response.status_code in (200, 206):
+        immutable(response, etag, max_age)
+    return response
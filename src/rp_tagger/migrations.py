@@ -0,0 +1,235 @@
+"""
+Versioned schema migrations. `create_all` only creates what is missing so
+anything that changes an existing table goes here. The version of the
+schema is kept in `PRAGMA user_version`.
+
+New databases are created from the models and stamped with the last
+version. The migrations check what is already there because databases
+created by `create_all` between versions may have some of the changes.
+"""
+import os
+import logging
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+
+from rp_tagger.db import Base, create_tag_fts
+
+log = logging.getLogger("user_info.migrations")
+
+MIGRATIONS = []
+
+
+def migration(version):
+    def decorator(func):
+        MIGRATIONS.append((version, func))
+        MIGRATIONS.sort(key=lambda migration: migration[0])
+        return func
+
+    return decorator
+
+
+def get_version(connection):
+    return connection.execute(text("PRAGMA user_version")).scalar()
+
+
+def set_version(connection, version):
+    # pragmas don't take parameters
+    connection.execute(text(f"PRAGMA user_version = {int(version)}"))
+
+
+def latest_version():
+    return MIGRATIONS[-1][0]
+
+
+def has_column(connection, table, column):
+    return any(col["name"] == column for col in inspect(connection).get_columns(table))
+
+
+def add_column(connection, table, column, ddl):
+    if not has_column(connection, table, column):
+        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def migrate(engine):
+    """Applies the pending migrations. Returns the versions applied"""
+    with engine.begin() as connection:
+        if not inspect(connection).has_table("image"):
+            Base.metadata.create_all(connection)
+            set_version(connection, latest_version())
+            log.info("Created the DB. Version %d", latest_version())
+            return []
+
+    applied = []
+    for version, func in MIGRATIONS:
+        # one transaction per migration, DDL included
+        with engine.begin() as connection:
+            if get_version(connection) >= version:
+                continue
+            log.info("Applying migration %d: %s", version, func.__doc__.strip())
+            func(connection)
+            set_version(connection, version)
+        applied.append(version)
+    return applied
+
+
+@migration(1)
+def image_hashes(connection):
+    """Columns for duplicate detection"""
+    from rp_tagger.ingest import HASH_DELM, quick_hash
+
+    add_column(connection, "image", "size", "INTEGER")
+    add_column(connection, "image", "quick_hash", "VARCHAR")
+    add_column(connection, "image", "content_hash", "VARCHAR")
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_image_size ON image (size)"))
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_image_content_hash ON image (content_hash)")
+    )
+
+    # the name is the md5 of the file
+    rows = connection.execute(
+        text("SELECT id, name, path FROM image WHERE content_hash IS NULL")
+    ).all()
+    for id, name, path in rows:
+        params = {"id": id, "size": None, "quick_hash": None, "content_hash": None}
+        if name.startswith(HASH_DELM):
+            params["content_hash"] = name[len(HASH_DELM) :].split(".")[0]
+        if os.path.exists(path):
+            params["size"] = os.stat(path).st_size
+            params["quick_hash"] = quick_hash(path, params["size"])
+        connection.execute(
+            text(
+                "UPDATE image SET size = :size, quick_hash = :quick_hash, "
+                "content_hash = :content_hash WHERE id = :id"
+            ),
+            params,
+        )
+
+
+@migration(2)
+def tag_trigram_index(connection):
+    """Trigram index over tag.name"""
+    create_tag_fts(connection)
+
+
+@migration(3)
+def usage_counts(connection):
+    """Denormalized tag.usage_count and image.tag_count"""
+    add_column(connection, "tag", "usage_count", "INTEGER NOT NULL DEFAULT 0")
+    add_column(connection, "image", "tag_count", "INTEGER NOT NULL DEFAULT 0")
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_tag_usage_count ON tag (usage_count)")
+    )
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_image_tag_count ON image (tag_count)")
+    )
+    recount(connection)
+
+
+@migration(4)
+def image_hits_id_index(connection):
+    """(hits, id) index for the keyset pagination"""
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_image_hits_id ON image (hits, id)")
+    )
+
+
+@migration(5)
+def assoc_primary_key(connection):
+    """Primary key and reverse index on assoc_tagged_image"""
+    pk = inspect(connection).get_pk_constraint("assoc_tagged_image")
+    if pk["constrained_columns"] != ["image_id", "tag_id"]:
+        # sqlite can't add a primary key to a table, it has to be rebuilt
+        connection.execute(text("ALTER TABLE assoc_tagged_image RENAME TO _assoc_tagged_image"))
+        Base.metadata.tables["assoc_tagged_image"].create(connection)
+        connection.execute(
+            text(
+                "INSERT OR IGNORE INTO assoc_tagged_image (image_id, tag_id) "
+                "SELECT image_id, tag_id FROM _assoc_tagged_image"
+            )
+        )
+        connection.execute(text("DROP TABLE _assoc_tagged_image"))
+        # duplicated rows were counted twice
+        recount(connection)
+    connection.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_assoc_tagged_image_tag_id_image_id "
+            "ON assoc_tagged_image (tag_id, image_id)"
+        )
+    )
+    connection.execute(text("ANALYZE"))
+
+
+@migration(6)
+def autotag_jobs(connection):
+    """Work queue of the auto tagging jobs"""
+    for name in ("autotag_job", "autotag_chunk"):
+        Base.metadata.tables[name].create(connection, checkfirst=True)
+
+
+@migration(7)
+def inference_scores(connection):
+    """Cache of the model scores and the threshold of the jobs"""
+    Base.metadata.tables["inference_score"].create(connection, checkfirst=True)
+    add_column(connection, "autotag_job", "threshold", "FLOAT")
+
+
+@migration(8)
+def perceptual_hashes(connection):
+    """image.phash for the near duplicates"""
+    # `manage.py dedupe` hashes the images that don't have one
+    add_column(connection, "image", "phash", "INTEGER")
+
+
+@migration(9)
+def autotag_stage_times(connection):
+    """Seconds per stage of the auto tagging chunks"""
+    for stage in ("decode", "wait", "inference", "write"):
+        add_column(connection, "autotag_chunk", f"{stage}_seconds", "FLOAT")
+    add_column(connection, "autotag_chunk", "cached", "INTEGER")
+    add_column(connection, "autotag_chunk", "skipped", "INTEGER")
+
+
+@migration(10)
+def phash_failures(connection):
+    """image.phash_failed for the files dhash can't read"""
+    add_column(connection, "image", "phash_failed", "BOOLEAN NOT NULL DEFAULT 0")
+
+
+def recount(connection):
+    connection.execute(
+        text(
+            "UPDATE tag SET usage_count = "
+            "(SELECT count(*) FROM assoc_tagged_image WHERE tag_id = tag.id)"
+        )
+    )
+    connection.execute(
+        text(
+            "UPDATE image SET tag_count = "
+            "(SELECT count(*) FROM assoc_tagged_image WHERE image_id = image.id)"
+        )
+    )
+
+
+def explain(engine):
+    """EXPLAIN QUERY PLAN of the main queries of DBClient"""
+    from rp_tagger.api import DBClient
+
+    client = DBClient(engine=engine, index=None)
+    plans = {}
+    for name, query in client.main_queries().items():
+        sql = str(query.compile(engine, compile_kwargs={"literal_binds": True}))
+        try:
+            rows = client.session.execute(text("EXPLAIN QUERY PLAN " + sql)).all()
+            plans[name] = [row[-1] for row in rows]
+        except OperationalError as exc:
+            # the schema is too old for the query
+            plans[name] = [str(exc.orig)]
+    return plans
+
+
+def print_plans(plans):
+    for name, plan in plans.items():
+        print(f"{name}:")
+        for line in plan:
+            print(f"    {line}")
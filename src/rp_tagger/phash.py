@@ -0,0 +1,217 @@
+"""
+Perceptual hashes to find the re-encoded, resized or re-saved copies of an
+image. The dHash of an image is 64 bits of "is this pixel brighter than the
+next one" over a 9x8 grayscale thumbnail, close images have hashes a few
+bits apart.
+
+The hashes are searched with multi-index hashing: every hash is split in
+`parts` substrings with a table each. Two hashes at most `distance` bits
+apart have at least one substring at most `distance // parts` bits apart so
+only the buckets of those few variations have to be looked at.
+"""
+import os
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import combinations
+
+from sqlalchemy import select
+
+from rp_tagger.api import chunked
+from rp_tagger.conf import settings
+from rp_tagger.db import Image
+from rp_tagger.index import popcount
+from rp_tagger.log import logged
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+log = logging.getLogger("user_info.phash")
+
+BITS = 64
+MASK = (1 << BITS) - 1
+# files PIL can't open
+SKIP = (".webm",)
+
+
+def dhash(path):
+    """
+    dHash of the image as a signed 64 bit integer, what sqlite can store.
+    None if PIL is not installed or it can't read the file
+    """
+    if PILImage is None or str(path).endswith(SKIP):
+        return None
+    try:
+        with PILImage.open(path) as img:
+            # jpegs are decoded at a fraction of the size
+            img.draft("L", (64, 64))
+            pixels = list(img.convert("L").resize((9, 8), PILImage.LANCZOS).getdata())
+    except Exception:
+        # OSError, DecompressionBombError, truncated files...
+        return None
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left, right = pixels[row * 9 + col], pixels[row * 9 + col + 1]
+            value = value << 1 | (left > right)
+    return value - (1 << BITS) if value >> (BITS - 1) else value
+
+
+@lru_cache(maxsize=None)
+def flip_masks(width, bits):
+    """The xor masks that flip up to `bits` of `width` bits"""
+    masks = [0]
+    for flipped in range(1, bits + 1):
+        for positions in combinations(range(width), flipped):
+            masks.append(sum(1 << position for position in positions))
+    return masks
+
+
+@logged
+class PHashIndex:
+    """
+    Hamming distance index of the perceptual hashes of the images, it lives
+    in the process that loaded it like the tag index.
+    """
+
+    def __init__(self, parts=settings.PHASH_INDEX_PARTS):
+        self.parts = parts
+        self.width = BITS // parts
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.loaded = False
+            # image id -> hash
+            self.hashes = {}
+            # one table per substring: substring -> image ids
+            self.tables = [{} for _ in range(self.parts)]
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def load(self, session):
+        with self.lock:
+            self.reset()
+            rows = session.execute(select(Image.id, Image.phash).where(Image.phash.isnot(None)))
+            for id, value in rows:
+                self.add(id, value)
+            self.loaded = True
+        self.logger.info("Loaded the perceptual hashes of %d images", len(self))
+
+    def _split(self, value):
+        mask = (1 << self.width) - 1
+        return [(value >> (i * self.width)) & mask for i in range(self.parts)]
+
+    def add(self, image_id, value):
+        value &= MASK
+        with self.lock:
+            if image_id in self.hashes:
+                self.remove(image_id)
+            self.hashes[image_id] = value
+            for table, key in zip(self.tables, self._split(value)):
+                table.setdefault(key, []).append(image_id)
+
+    def remove(self, image_id):
+        with self.lock:
+            value = self.hashes.pop(image_id, None)
+            if value is None:
+                return
+            for table, key in zip(self.tables, self._split(value)):
+                bucket = table[key]
+                bucket.remove(image_id)
+                if not bucket:
+                    del table[key]
+
+    def search(self, value, max_distance=settings.PHASH_DISTANCE):
+        """[(distance, image id)] of the hashes at most `max_distance` bits away, closest first"""
+        value &= MASK
+        # with d = q * parts + r, one of the first r + 1 substrings is at
+        # most q bits away or one of the others at most q - 1 bits away
+        q, r = divmod(max_distance, self.parts)
+        found = set()
+        with self.lock:
+            hashes = self.hashes
+            for i, (table, key) in enumerate(zip(self.tables, self._split(value))):
+                bits = q if i <= r else q - 1
+                if bits < 0:
+                    break
+                get = table.get
+                for mask in flip_masks(self.width, bits):
+                    bucket = get(key ^ mask)
+                    if bucket:
+                        found.update(
+                            id for id in bucket if popcount(value ^ hashes[id]) <= max_distance
+                        )
+            return sorted((popcount(value ^ hashes[id]), id) for id in found)
+
+    def clusters(self, max_distance=settings.PHASH_DISTANCE):
+        """
+        Groups of images linked by hashes at most `max_distance` bits apart.
+        Returns the lists of ids of the groups with more than one image
+        """
+        parent = {}
+
+        def find(id):
+            root = id
+            while parent.get(root, root) != root:
+                root = parent[root]
+            # path compression
+            while id != root:
+                parent[id], id = root, parent[id]
+            return root
+
+        with self.lock:
+            for image_id, value in self.hashes.items():
+                for _, other in self.search(value, max_distance):
+                    a, b = find(image_id), find(other)
+                    if a != b:
+                        parent[max(a, b)] = min(a, b)
+            groups = {}
+            for image_id in self.hashes:
+                groups.setdefault(find(image_id), []).append(image_id)
+        return sorted(
+            (sorted(ids) for ids in groups.values() if len(ids) > 1),
+            key=lambda ids: (-len(ids), ids[0]),
+        )
+
+
+def hash_missing(client, workers=None, batch_size=settings.BULK_BATCH_SIZE):
+    """
+    Computes the perceptual hash of the images that don't have one, in
+    `workers` processes. The ones it can't read are marked so the next run
+    skips them. Returns the number of images hashed
+    """
+    if PILImage is None:
+        raise RuntimeError("Pillow is not installed")
+    missing = client.missing_phashes()
+    client.remove()
+    hashed = 0
+    with ProcessPoolExecutor(workers or os.cpu_count()) as pool:
+        for batch in chunked(missing, batch_size):
+            values = pool.map(dhash, [path for _, path in batch], chunksize=64)
+            hashes, failed = {}, []
+            for (id, path), value in zip(batch, values):
+                if value is None:
+                    log.warning("Can't compute the perceptual hash of %s", path)
+                    failed.append(id)
+                else:
+                    hashes[id] = value
+            client.set_phashes(hashes, failed)
+            hashed += len(hashes)
+    return hashed
+
+
+def find_duplicates(client, max_distance=settings.PHASH_DISTANCE):
+    """Clusters of near duplicates as lists of (id, path)"""
+    index = PHashIndex()
+    index.load(client.session)
+    clusters = index.clusters(max_distance)
+    paths = dict(
+        client.session.execute(select(Image.id, Image.path).where(Image.phash.isnot(None))).all()
+    )
+    return [[(id, paths[id]) for id in ids] for ids in clusters]
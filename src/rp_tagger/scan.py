@@ -0,0 +1,138 @@
+"""
+Single-pass directory scanner for the source folder
+"""
+import os
+import json
+from pathlib import Path
+
+from rp_tagger.conf import settings
+from rp_tagger.log import logged
+
+# "*.png" -> ".png"
+EXTENSIONS = tuple(pattern.lstrip("*") for pattern in settings.ACCEPT)
+
+
+def guess_tags(path, root_parts):
+    """We try to guess the tags from the folders"""
+    return list(set(Path(path).parent.parts).difference(root_parts))
+
+
+def walk_images(path=settings.IMAGES_FROM_DIR):
+    """Walks the folder once and yields every accepted file with its tags"""
+    root_parts = set(Path(path).parts)
+    stack = [str(path)]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            # glob ignores hidden files
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.name.endswith(EXTENSIONS):
+                yield {"path": entry.path, "tags": guess_tags(entry.path, root_parts)}
+
+
+@logged
+class Scanner:
+    """
+    Incremental version of `walk_images`. It remembers the mtime of every
+    directory and the (size, mtime) of every file it has seen; directories
+    whose mtime didn't change are not listed again and only new or changed
+    files are yielded.
+
+    The manifest is written to `manifest_path` by `save`, call it once the
+    files yielded were taken care of.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path=settings.IMAGES_FROM_DIR, manifest_path=settings.SCAN_MANIFEST):
+        self.path = str(path)
+        self.manifest_path = manifest_path and Path(manifest_path)
+        self.dirs = {}
+        self.load()
+
+    def load(self):
+        if not self.manifest_path or not self.manifest_path.exists():
+            return
+        try:
+            with open(self.manifest_path) as file:
+                manifest = json.load(file)
+        except ValueError:
+            self.logger.warning("Corrupted scan manifest %s. Scanning from scratch", self.manifest_path)
+            return
+        if manifest.get("version") == self.VERSION and manifest.get("root") == self.path:
+            self.dirs = manifest["dirs"]
+
+    def save(self):
+        if not self.manifest_path:
+            return
+        tmp = self.manifest_path.with_suffix(".tmp")
+        with open(tmp, "w") as file:
+            json.dump({"version": self.VERSION, "root": self.path, "dirs": self.dirs}, file)
+        os.replace(tmp, self.manifest_path)
+
+    def reset(self):
+        self.dirs = {}
+
+    def forget(self, paths):
+        """The next scan yields these files again, for the ones that couldn't be ingested"""
+        for path in paths:
+            directory, name = os.path.split(path)
+            entry = self.dirs.get(directory)
+            if entry is not None:
+                entry["files"].pop(name, None)
+                # the folder has to be listed again to find them
+                entry["mtime"] = None
+
+    def scan(self):
+        root_parts = set(Path(self.path).parts)
+        seen = {}
+        stack = [self.path]
+        listed = 0
+        while stack:
+            directory = stack.pop()
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except FileNotFoundError:
+                continue
+
+            old = self.dirs.get(directory)
+            if old is not None and old["mtime"] == mtime:
+                seen[directory] = old
+                stack.extend(old["subdirs"])
+                continue
+
+            listed += 1
+            old_files = old["files"] if old is not None else {}
+            subdirs = []
+            files = {}
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.name.endswith(EXTENSIONS):
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+                        if old_files.get(entry.name) != files[entry.name]:
+                            yield {
+                                "path": entry.path,
+                                "tags": guess_tags(entry.path, root_parts),
+                            }
+
+            seen[directory] = {"mtime": mtime, "subdirs": subdirs, "files": files}
+            stack.extend(subdirs)
+
+        # forget about the directories that were removed
+        self.dirs = seen
+        self.logger.debug("Scanned %s. Listed %d of %d folders", self.path, listed, len(seen))
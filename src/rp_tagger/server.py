@@ -1,25 +1,19 @@
-import os
-import hashlib
+import sqlalchemy.exc
+from flask import Flask, render_template, request, redirect, url_for, jsonify, make_response
+from flask import Response, stream_with_context
 
-from flask import Flask, render_template, request, redirect, url_for
-
-from rp_tagger.api import load_images, DBClient
+from rp_tagger.api import DBClient
+from rp_tagger.backup import export_images, gzipped, to_ndjson
 from rp_tagger.conf import settings
-
-try:
-    # auto tagging
-    import hydrus_dd as hydrus
-    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
-    from hydrus_dd import evaluate
-    from hydrus_dd.__main__ import load_model_and_tags
-
-except ImportError:
-    hydrus = None
+from rp_tagger.ingest import Ingestor
+from rp_tagger.counters import HitBuffer
+from rp_tagger.autotag import AutoTagger, AutotagJobs
+from rp_tagger.jobs import Jobs
+from rp_tagger.media import send_media
 
 app = Flask(__name__)
 
 TAG_SEPARATOR = "_"
-HASH_DELM = "__"
 PAGE_SIZE = 6
 
 CACHE = {"images": []}
@@ -27,53 +21,52 @@ CACHE = {"images": []}
 UNCLS_IMAGES_DIR = settings.UNCLS_IMAGES_DIR
 IMAGES_DIR = settings.IMAGES_DIR
 
-client = DBClient()
-
-def gen_img_obj(images):
-    for image in images:
-        path = image["path"]
-        ext = path.split(".")[-1]
-        app.logger.info("Loaded image %s", path.split("/")[-1])
-
-        with open(image["path"], "r+b") as infile:
-            data = infile.read()
-        # to avoid duplicates
-        name = HASH_DELM + hashlib.md5(data).hexdigest() + "." + ext
-        image["name"] = name
-        old_path = image["path"]
-        new_path = UNCLS_IMAGES_DIR / name
-            
-        if new_path.exists():
-            app.logger.info("Duplicate found: %s at %s", name, image["path"])
-            continue
-        image["path"] = str(new_path)
-        yield image
-
-        # after the image was successfully added to the DB
-        if settings.DELETE_ORIGINAL:
-            os.rename(old_path, new_path)
-        else:
-            with open(old_path, "r+b") as infile:
-                with open(new_path, "w+b") as outfile:
-                    outfile.write(infile.read())
-
-def _sync_new():
-
-    new_images = load_images()
-
-    app.logger.info("Loaded %d new images", len(new_images))
-
-    if new_images or not any(CACHE.values()):
-        client.dump_unclassified(gen_img_obj(new_images))
-
-        app.logger.info(
-            "There is a total of images of %d images",
-            client.count_images()
-        )
+hit_buffer = HitBuffer(DBClient)
+# every thread gets its own session, see teardown
+client = DBClient(hits=hit_buffer)
+# new files are picked up in the background
+ingestor = Ingestor()
+autotag_jobs = AutotagJobs(client)
+# long operations, they get their own sessions
+jobs = Jobs(client)
+
+@jobs.task("tree")
+def tree_job(job, client, min_elements=5):
+    job.update(message="Exporting the tree")
+    return client.make_tree(min_elements, progress=lambda done, total: job.update(done / total))
+
+@jobs.task("rescan")
+def rescan_job(job, client):
+    def progress(done, total):
+        job.update(done / total)
+        # between batches
+        job.check()
+
+    job.update(message=f"Scanning {ingestor.path}")
+    return {"files": ingestor.rescan(client, progress)}
+
+@jobs.task("autotag")
+def autotag_job(job, client, threshold=None):
+    autotag_id = autotag_jobs.start(threshold)
+    job.update(message=f"Auto tagging job {autotag_id}")
+    while autotag_jobs.running():
+        if job.cancelled:
+            autotag_jobs.cancel(autotag_id)
+        job.update(autotag_jobs.progress(autotag_id)["progress"])
+        client.remove()
+        autotag_jobs.join(1)
+    return autotag_jobs.progress(autotag_id)
+
+@app.teardown_appcontext
+def teardown(exc=None):
+    # one session per request
+    client.remove()
 
 @app.route("/")
 def index():
-    most_used_tags = list(map(lambda i: i.as_dict(), client.get_most_used_tags()))
+    most_used_tags = client.cached(
+        ("most_used_tags",), lambda: [tag.as_dict() for tag in client.get_most_used_tags()]
+    )
 
     app.logger.info("Most used tags: %s", most_used_tags)
 
@@ -81,69 +74,87 @@ def index():
 
 @app.route("/data-images")
 def data_images():
-    """Yields rendered html code with the images"""
-    page = 0
+    """Yields rendered html code with the images. The cursor of the next page
+    goes in the X-Next-Cursor header"""
+    cursor = request.args.get("cursor") or None
     tags = []
 
-    if "page" in request.args:
-        page = int(request.args["page"])
     if "tags" in request.args and request.args["tags"]:
         # expect space separated list of tags
         tags = request.args["tags"].split(" ")
 
-    _sync_new()
-
-    # paginate the result from the cache. 5 per page
-    raw_images = client.get_paginated_result(PAGE_SIZE*page, PAGE_SIZE, tags=tags)
-    images = list(map(lambda i: i.as_dict(), raw_images))
+    def render_page():
+        images, next_cursor = client.read_page(
+            PAGE_SIZE, tags=tags, cursor=cursor, with_tags=False, touch=False
+        )
+        app.logger.info("Loaded %d images. Cursor %s", len(images), cursor)
+        return render_template("list.html", images=images), next_cursor
 
+    for tag in tags:
+        client.touch_tag(tag)
+    try:
+        html, next_cursor = client.cached(("data-images", tuple(tags), cursor), render_page)
+    except ValueError as exc:
+        return (str(exc), 400)
 
-    app.logger.info("Loaded %d images. Page %d", len(images), page)
-    return render_template("list.html", images=images) 
+    response = make_response(html)
+    response.headers["X-Next-Cursor"] = next_cursor or ""
+    return response
 
 @app.route("/classify")
 def classify():
     """Yield new images to tag them"""
 
-    _sync_new()
     if len(CACHE["images"]) == 0:
         images = client.load_less_tagged()
         if not any(images):
             app.logger.info("Empty database. Can't classify anything.")
             return redirect(url_for("index"))
-        CACHE["images"] = images
+        # the session of this request is gone by the next one
+        CACHE["images"] = client.image_records(images, with_tags=False)
 
     if not "id" in request.args:
-        image = CACHE["images"][-1].as_dict()
+        image = client.image_records(CACHE["images"][-1:])[0]
     else:
         id = int(request.args["id"])
-        image = client.query_image(id=id).as_dict()
+        image = client.read_image(id)
 
-    raw_tags = client.get_most_popular_tags()
-    popular_tags = list(map(lambda t: t.as_dict(), raw_tags))
+    # the tags that usually go with the ones it has
+    popular_tags = [{"name": name} for name in client.suggest_tags(image.tags)]
 
     return render_template("detail.html", image=image, popular_tags=popular_tags)
 
 @app.route("/auto-classify")
 def auto_classify():
-    if hydrus is None:
+    """Starts (or resumes) the auto tagging job. It runs in the background"""
+    if not AutoTagger.available():
         return ("hydrus-dd is not installed.", 400)
-    model, tags = load_model_and_tags(settings.MODEL_DIR / "model.h5", settings.MODEL_DIR / "tags.txt", compile_=None)
-
-    images = [1]
-    while any(images):
-        images = client.load_less_tagged_images()
-        for image in images:
-            if image.name.endswith("webp") or image.name.endswith("webm") or image.name.endswith("gif"):
-                continue
-            path = image.path
-            response = set(evaluate.eval(image_path=path, threshold=0.5, model=model, tags=tags))
-            assert any(response), f"Error, response is nil {response}"
-            app.logger.info("Guessed tags: %s for image %s", response, image.name)
-            client.update_image(id=image.id, tags=response)
-            app.logger.info("Successfully tagged %s images", image.path)
-    return ("Everything should be tagged now.", 200)
-
+    try:
+        threshold = float(request.args["threshold"]) if "threshold" in request.args else None
+    except ValueError:
+        return ("The threshold must be a number", 400)
+    job_id = jobs.submit("autotag", threshold=threshold)
+    app.logger.info("Auto tagging job %d queued", job_id)
+    return job_accepted(job_id)
+
+@app.route("/auto-classify/<int:job_id>")
+def auto_classify_status(job_id):
+    """Progress and ETA of the job"""
+    try:
+        return jsonify(autotag_jobs.progress(job_id))
+    except sqlalchemy.exc.NoResultFound:
+        return ("No such job", 404)
+
+@app.route("/auto-classify/<int:job_id>/cancel", methods=["POST"])
+def auto_classify_cancel(job_id):
+    autotag_jobs.cancel(job_id)
+    return jsonify(autotag_jobs.progress(job_id))
+
+
+@app.route("/media/<name>")
+def media(name):
+    """The files of the library, cached by the browser for good"""
+    return send_media(UNCLS_IMAGES_DIR, name)
 
 @app.route("/add_tags", methods=["POST"])
 def add_tags():
@@ -158,11 +169,9 @@ def add_tags():
 
     app.logger.info("tags: %s; name: %s", tags, id)
 
-    _sync_new()
     # check if we get the image from cache or not
     if len(CACHE["images"]) > 0:
-        img = CACHE["images"][-1].as_dict()
-        if img["id"] == id:
+        if CACHE["images"][-1].id == id:
             # it will eventually empty and we will get more from the DB
             CACHE["images"].pop()
     # if is not the last image or the cache is empty, 
@@ -188,14 +197,75 @@ def tree():
     if request.method == "GET":
         return render_template("tree.html")
     # it won't allow other than GET and POST
-    client.make_tree()
-    # XXX i know
-    client.already_queried = []
-
-    return redirect(url_for("index"))
+    job_id = jobs.submit("tree")
+    return redirect(url_for("job_status", job_id=job_id), code=303)
+
+@app.route("/rescan", methods=["POST"])
+def rescan():
+    """Looks at every file of the source folder again"""
+    return job_accepted(jobs.submit("rescan"))
+
+def job_accepted(job_id):
+    response = jsonify(jobs.get(job_id))
+    response.headers["Location"] = url_for("job_status", job_id=job_id)
+    return (response, 202)
+
+@app.route("/jobs")
+def job_list():
+    return jsonify(jobs.list())
+
+@app.route("/jobs/<int:job_id>")
+def job_status(job_id):
+    """Status and progress (0 to 1) of the job"""
+    try:
+        return jsonify(jobs.get(job_id))
+    except KeyError:
+        return ("No such job", 404)
+
+@app.route("/jobs/<int:job_id>/cancel", methods=["POST"])
+def job_cancel(job_id):
+    try:
+        jobs.cancel(job_id)
+    except KeyError:
+        return ("No such job", 404)
+    return jsonify(jobs.get(job_id))
+
+@app.route("/api/export")
+def api_export():
+    """Every image with its tags, one JSON per line. ?gzip=1 to compress it"""
+    lines = to_ndjson(export_images(client))
+    if request.args.get("gzip"):
+        response = Response(stream_with_context(gzipped(lines)), mimetype="application/gzip")
+        response.headers["Content-Disposition"] = "attachment; filename=library.ndjson.gz"
+        return response
+    return Response(stream_with_context(lines), mimetype="application/x-ndjson")
+
+@app.route("/status/ingest")
+def ingest_status():
+    return jsonify(ingestor.status())
+
+@app.route("/status/autotag")
+def autotag_status():
+    """Time spent decoding, waiting for the decoders, in the model and writing by the last job"""
+    return jsonify(autotag_jobs.stage_times() or {})
+
+@app.route("/status/hits")
+def hits_status():
+    return jsonify(hit_buffer.status())
+
+@app.route("/status/cache")
+def cache_status():
+    """Hits, misses and evictions of the cache of the views"""
+    return jsonify(client.cache.status() if client.cache is not None else {})
 
 def runserver():
-    app.run(host="0.0.0.0",port=5050)
+    ingestor.start()
+    hit_buffer.start()
+    if AutoTagger.available() and autotag_jobs.queue.active_job() is not None:
+        # a job interrupted by a restart
+        jobs.submit("autotag")
+        client.remove()
+    app.run(host="0.0.0.0",port=5050, threaded=True)
 
 if __name__ == "__main__":
     runserver()
@@ -1,5 +1,7 @@
-from rp_tagger.db import Base, create_engine
+from rp_tagger.db import Base, make_engine
 from rp_tagger.conf import settings
+from rp_tagger.index import tag_index
+from rp_tagger.cache import query_cache
 
 db = settings.DATABASES["default"]
 ENGINE = db["engine"]
@@ -10,10 +12,14 @@ def build_test_db(
     """
     Create test database and schema.
     """
-    engine = create_engine(name)
+    engine = make_engine(name)
 
     # Nuke everything and build it from scratch.
     Base.metadata.drop_all(engine)
     Base.metadata.create_all(engine)
+    if tag_index is not None:
+        tag_index.reset()
+    if query_cache is not None:
+        query_cache.clear()
 
     return engine
@@ -0,0 +1,80 @@
+"""
+Compares the old auto tagging (one evaluate.eval per image) with the
+batched AutoTagger, with and without the decode workers. Needs hydrus-dd
+and the model in MODEL_DIR.
+
+    python -m rp_tagger.test.bench_autotag [folder] [images] [batch sizes...]
+"""
+import sys
+import time
+from types import SimpleNamespace
+
+from rp_tagger.autotag import AutoTagger, load_model
+from rp_tagger.conf import settings
+from rp_tagger.scan import walk_images
+
+BATCH_SIZES = (1, 8, 32, 64)
+IMAGES = 128
+SKIP = (".gif", ".webm", ".webp")
+
+
+def per_image(paths, model, tags):
+    from hydrus_dd import evaluate
+
+    for path in paths:
+        evaluate.eval(image_path=path, threshold=settings.AUTOTAG_THRESHOLD, model=model, tags=tags)
+
+
+def batched(paths, batch_size, workers=0):
+    tagger = AutoTagger(batch_size=batch_size, workers=workers)
+    images = [SimpleNamespace(id=i, path=path) for i, path in enumerate(paths)]
+    for _ in tagger.tag_images(images):
+        pass
+    return tagger.status()
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def bench(folder, count, batch_sizes):
+    paths = [
+        image["path"] for image in walk_images(folder) if not image["path"].endswith(SKIP)
+    ][:count]
+    if not paths:
+        sys.exit(f"No images in {folder}")
+
+    duration = timed(load_model, settings.MODEL_DIR)
+    print(f"model loaded in {duration:.2f}s (once per process)")
+    model, tags = load_model(settings.MODEL_DIR)
+    # warm up
+    batched(paths[:2], 2)
+
+    print(f"{len(paths)} images")
+    print(f"{'mode':>12} {'seconds':>8} {'images/s':>9}")
+    duration = timed(per_image, paths, model, tags)
+    print(f"{'evaluate':>12} {duration:>8.2f} {len(paths) / duration:>9.2f}")
+    for batch_size in batch_sizes:
+        duration = timed(batched, paths, batch_size)
+        print(f"{f'batch {batch_size}':>12} {duration:>8.2f} {len(paths) / duration:>9.2f}")
+
+    # decoding in other processes
+    batch_size = max(batch_sizes)
+    start = time.perf_counter()
+    status = batched(paths, batch_size, settings.AUTOTAG_DECODE_WORKERS)
+    duration = time.perf_counter() - start
+    print(f"{f'prefetch {batch_size}':>12} {duration:>8.2f} {len(paths) / duration:>9.2f}")
+    print(", ".join(f"{stage} {status[stage]:.2f}s" for stage in AutoTagger.STAGES))
+
+
+if __name__ == "__main__":
+    if not AutoTagger.available():
+        sys.exit("hydrus-dd is not installed")
+    args = sys.argv[1:]
+    bench(
+        args[0] if args else settings.IMAGES_FROM_DIR,
+        int(args[1]) if len(args) > 1 else IMAGES,
+        [int(arg) for arg in args[2:]] or BATCH_SIZES,
+    )
@@ -0,0 +1,65 @@
+"""
+Compares the trigram index of the tags with the plain LIKE '%name%' scan.
+
+    python -m rp_tagger.test.bench_tag_search [sizes...]
+"""
+import sys
+import random
+import string
+import timeit
+from tempfile import TemporaryDirectory
+
+from sqlalchemy import insert, text
+
+from rp_tagger.api import match_tags
+from rp_tagger.db import Tag, create_db
+
+SIZES = (10_000, 100_000)
+TERMS = ("gir", "hair", "xyz", "long_h", "ab")
+REPEAT = 20
+
+WORDS = [
+    "girl", "hair", "long", "short", "blue", "eyes", "smile", "book",
+    "holding", "sky", "cloud", "water", "solo", "looking", "at", "viewer",
+]
+
+
+def random_tag():
+    words = random.sample(WORDS, random.randint(1, 3))
+    suffix = "".join(random.choices(string.ascii_lowercase, k=4))
+    return "_".join(words + [suffix])
+
+
+def bench(size):
+    with TemporaryDirectory() as tmp:
+        engine = create_db(f"sqlite:///{tmp}/bench.sqlite")
+        names = {random_tag() for _ in range(size)}
+        with engine.begin() as connection:
+            connection.execute(insert(Tag), [{"name": name} for name in names])
+
+        print(f"{len(names)} tags")
+        print(f"{'term':>8} {'matches':>8} {'like (ms)':>10} {'fts (ms)':>10}")
+        with engine.connect() as connection:
+            for term in TERMS:
+                like = match_tags(term, fts=False)
+                fts = match_tags(term)
+
+                matches = len(connection.execute(like).all())
+                assert matches == len(connection.execute(fts).all())
+                times = [
+                    min(timeit.repeat(lambda: connection.execute(stmt).all(), number=1, repeat=REPEAT))
+                    for stmt in (like, fts)
+                ]
+                print(f"{term:>8} {matches:>8} {times[0] * 1000:>10.2f} {times[1] * 1000:>10.2f}")
+
+            for fts in (False, True):
+                stmt = match_tags("hair", fts=fts)
+                compiled = stmt.compile(engine, compile_kwargs={"literal_binds": True})
+                plan = connection.execute(text(f"EXPLAIN QUERY PLAN {compiled}")).all()
+                print(compiled, "->", "; ".join(row[-1] for row in plan))
+        print()
+
+
+if __name__ == "__main__":
+    for size in [int(arg) for arg in sys.argv[1:]] or SIZES:
+        bench(size)
@@ -8,7 +8,7 @@ except ImportError:
     requests = None
 
 from rp_tagger.conf import settings, ENVIRONMENT_VARIABLE
-from rp_tagger.server import app
+from rp_tagger.server import app, ingestor, hit_buffer
 from rp_tagger.test import build_test_db
 
 PORT = 14548
@@ -17,6 +17,8 @@ HOST = "localhost"
 def run_test_server():
     var = os.environ.get(ENVIRONMENT_VARIABLE)
     os.environ[ENVIRONMENT_VARIABLE] = "rp_tagger.conf.dev"
+    ingestor.start()
+    hit_buffer.start()
     app.run(port=PORT)
 
     # clean up
@@ -52,18 +54,19 @@ class TestServer(unittest.TestCase):
 
         self.assertTrue(res.status_code, 200)
         # the images are appended via AJAX
-        self.assertNotIn("static/__debug__/__83b34cf54967dc5b4b86fcc6c2be7deb.png", res.text)
+        self.assertNotIn("/media/__83b34cf54967dc5b4b86fcc6c2be7deb.png", res.text)
 
         res = self.client.get(self.imgs_url)
 
-        img = "static/__debug__/__83b34cf54967dc5b4b86fcc6c2be7deb.png"
+        img = "media/__83b34cf54967dc5b4b86fcc6c2be7deb.png"
         self.assertEqual(res.status_code, 200)
-        self.assertIn(img, res.text)
+        self.assertIn("/" + img, res.text)
+        cursor = res.headers["X-Next-Cursor"]
 
-        res = self.client.head(self.url + "/" + img)
+        res = self.client.head(self.url + img)
         self.assertEqual(res.status_code, 200) # better error message
 
-        res = self.client.get(self.imgs_url + "?page=1")
+        res = self.client.get(self.imgs_url + "?cursor=" + cursor)
         self.assertIn("<a href=\"/classify?id=7\"", res.text)
 
     def test_tagger(self):
@@ -75,10 +78,30 @@ class TestServer(unittest.TestCase):
         tag = "<button name=\"tag\" id=\"id_tag_g\">g</button>"
         self.assertIn(tag, res.text)
 
-        #img = """<video id="8" src="static/__debug__/__e52e29058facca1dd2d021757294b540.webm" class="image-detail"></video>"""
-        img = """<img id="6" src="static/__debug__/__f20e54aa04d69b2892e58e724e6887bb.gif" class="image-detail"></img>"""
+        #img = """<video id="8" src="/media/__e52e29058facca1dd2d021757294b540.webm" class="image-detail"></video>"""
+        img = """<img id="6" src="/media/__f20e54aa04d69b2892e58e724e6887bb.gif" class="image-detail"></img>"""
         self.assertIn(img, res.text)
 
+    def test_media(self):
+        url = self.url + "media/__83b34cf54967dc5b4b86fcc6c2be7deb.png"
+        res = self.client.get(url)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers["ETag"], '"83b34cf54967dc5b4b86fcc6c2be7deb"')
+        self.assertIn("immutable", res.headers["Cache-Control"])
+        self.assertNotIn("no-cache", res.headers["Cache-Control"])
+        size = len(res.content)
+
+        # the browser has it already
+        res = self.client.get(url, headers={"If-None-Match": res.headers["ETag"]})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.content, b"")
+
+        res = self.client.get(url, headers={"Range": "bytes=0-9"})
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.headers["Content-Range"], f"bytes 0-9/{size}")
+        self.assertEqual(len(res.content), 10)
+
     def test_add_tags(self):
         data = {"id": 1, "tags[]": "test"}
         res = self.client.post(self.add_tag_url, data=data)
@@ -1,10 +1,40 @@
 import os
+import gzip
+import threading
 #from typing import Union
 from pathlib import Path
 import unittest
+import unittest.mock
+from contextlib import contextmanager
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine, event, insert, inspect, select, text
 
 from rp_tagger.db import Image, Tag, tag_relationship
 from rp_tagger.api import load_images, DBClient
+from rp_tagger.ingest import Ingestor, transfer_file
+from rp_tagger.scan import Scanner
+from rp_tagger.index import TagIndex
+from rp_tagger.phash import PHashIndex, PILImage, dhash, find_duplicates, hash_missing
+from rp_tagger.counters import HitBuffer
+from rp_tagger.cache import QueryCache
+from rp_tagger.backup import export_images, gzipped, import_images, read_dump, to_ndjson, write_dump
+from rp_tagger.export import Exporter
+from rp_tagger.jobs import Jobs
+from rp_tagger.media import send_media
+from rp_tagger.autotag import (
+    AutoTagger,
+    AutotagQueue,
+    ScoreCache,
+    decode_scores,
+    encode_scores,
+    load_model,
+    model_fingerprint,
+    work,
+    np as numpy,
+)
+from rp_tagger.migrations import MIGRATIONS, migrate, explain, get_version, latest_version
 from rp_tagger.conf import settings
 from rp_tagger.conf import _base
 from rp_tagger.test import build_test_db
@@ -46,18 +76,1133 @@ class Test_API(unittest.TestCase):
         y = images[0]
         self.assertEqual(x["path"], y["path"])
         tag_names = list(map(lambda t: t["name"], x["tags"]))
-        self.assertEqual(tag_names, y["tags"])
+        self.assertEqual(sorted(tag_names), sorted(y["tags"]))
 
         x_2 = uncls[1].as_dict()
         y_2 = images[1]
         self.assertEqual(x_2["path"], y_2["path"])
         tag_names = list(map(lambda t: t["name"], x_2["tags"]))
-        self.assertEqual(tag_names, y_2["tags"])
+        self.assertEqual(sorted(tag_names), sorted(y_2["tags"]))
+
+    def test_dump_unclassified_bulk(self):
+        images = [
+            {"name": f"{i}.png", "path": f"/{i}.png", "tags": ["a", f"tag_{i % 3}"]}
+            for i in range(10)
+        ]
+        self.client.dump_unclassified(images[:5], batch_size=2)
+        self.client.add_tag("tag_2")
+        self.client.dump_unclassified(images[5:], batch_size=2)
+
+        self.assertEqual(self.client.count_images(), 10)
+        self.assertEqual(self.client.session.query(Tag).count(), 4)
+        self.assertEqual(self.client.session.query(tag_relationship).count(), 20)
+
+        # everything or nothing
+        with self.assertRaises(Exception):
+            self.client.dump_unclassified(
+                [{"name": "new.png", "path": "/new.png", "tags": ["new"]}, images[0]]
+            )
+        self.assertEqual(self.client.count_images(), 10)
+        self.assertEqual(self.client.session.query(Tag).count(), 4)
+
+    def test_dump_unclassified_deleted_tag(self):
+        self.client.dump_unclassified([{"name": "1.png", "path": "/1.png", "tags": ["a"]}])
+        # another process
+        other = DBClient(engine=self.client.session.bind, index=None, cache=None)
+        other.delete_tag("a")
+        other.remove()
+
+        self.client.dump_unclassified([{"name": "2.png", "path": "/2.png", "tags": ["a"]}])
+        tag = self.client.session.query(Tag).filter(Tag.name == "a").one()
+        self.assertEqual(tag.usage_count, 1)
+        self.assertEqual(
+            [row.tag_id for row in self.client.session.query(tag_relationship)], [tag.id]
+        )
+
+    def test_match_tags(self):
+        for name in ("book", "Book", "library book", "g", "boo_ks", "booXks", "Éclair", "éclair"):
+            self.client.add_tag(name)
+        self.client.session.flush()
+        self.assertTrue(self.client.fts)
+
+        terms = ("book", "BOO", "g", "ook", "k_", "o_k", "%", "ÉCLAIR", "éclair", "CLAIR", "nothing")
+        for term in terms:
+            fts = set(self.client.session.execute(self.client.match_tags(term)).scalars())
+            self.client.fts = False
+            like = set(self.client.session.execute(self.client.match_tags(term)).scalars())
+            self.client.fts = True
+            self.assertEqual(fts, like, term)
+        # no wildcards
+        names = lambda term: set(
+            self.client.session.execute(
+                select(Tag.name).where(Tag.id.in_(self.client.match_tags(term)))
+            ).scalars()
+        )
+        self.assertEqual(names("o_k"), {"boo_ks"})
+        self.assertEqual(names("éclair"), {"éclair"})
+
+    def test_paginated_result(self):
+        images = [{"name": f"{i}.png", "path": f"/{i}.png", "tags": ["a"]} for i in range(10)]
+        self.client.dump_unclassified(images)
+        for id in (3, 3, 5, 8):
+            self.client.touch_image(id)
+
+        for client in (self.client, DBClient(engine=self.client.session.bind, index=TagIndex())):
+            for tags in (None, ["a"]):
+                ids = []
+                cursor = None
+                while True:
+                    page, cursor = client.get_paginated_result(3, tags=tags and list(tags), cursor=cursor)
+                    ids.extend(image.id for image in page)
+                    if cursor is None:
+                        break
+                self.assertEqual(ids, [3, 8, 5, 10, 9, 7, 6, 4, 2, 1], (client.index, tags))
+
+        with self.assertRaises(ValueError):
+            self.client.get_paginated_result(3, cursor="nope")
+
+    def test_paginated_result_sql(self):
+        # a: every image, b: the even ones, c: the multiples of 3
+        self.client.dump_unclassified(
+            [
+                {"name": f"{i}.png", "path": f"/{i}.png", "tags": ["a"] + ["b"] * (i % 2 == 0) + ["c"] * (i % 3 == 0)}
+                for i in range(12)
+            ]
+        )
+        for id in (7, 7, 5, 11):
+            self.client.touch_image(id)
+
+        # without the index the tags are searched with the keyset queries
+        client = DBClient(engine=self.client.session.bind, index=None)
+        for tags, expected in (
+            (["b"], [7, 11, 5, 9, 3, 1]),
+            (["c"], [7, 10, 4, 1]),
+            (["b", "c"], [7, 1]),
+        ):
+            ids = []
+            cursor = None
+            while True:
+                page, cursor = client.get_paginated_result(2, tags=list(tags), cursor=cursor)
+                ids.extend(image.id for image in page)
+                if cursor is None:
+                    break
+            self.assertEqual(ids, expected, tags)
+
+    def counts(self):
+        self.client.session.expire_all()
+        return (
+            dict(self.client.session.query(Tag.name, Tag.usage_count)),
+            dict(self.client.session.query(Image.id, Image.tag_count)),
+        )
+
+    def test_counts(self):
+        self.client.dump_unclassified(
+            [{"name": f"{i}.png", "path": f"/{i}.png", "tags": ["a", f"tag_{i % 2}"]} for i in range(4)]
+        )
+        self.client.update_image(1, tags=["a", "b", "b"])
+        self.client.add_image("new.png", "/new.png", ["b", "c"])
+        path = Path(TEST_DIR) / "to_delete.png"
+        path.write_bytes(b"")
+        self.client.update_image(2, path=str(path))
+        self.client.delete_image(2)
+        self.client.delete_tag("tag_0")
+
+        tags, images = self.counts()
+        self.assertEqual(tags, {"a": 3, "tag_1": 1, "b": 2, "c": 1})
+        self.assertEqual(images, {1: 2, 3: 1, 4: 2, 5: 2})
+
+        self.client.recount()
+        self.assertEqual(self.counts(), (tags, images))
+
+        popular = [tag.name for tag in self.client.get_most_popular_tags(limit=2)]
+        self.assertEqual(popular, ["a", "b"])
+        self.client.update_image(3, tags=[])
+        self.assertEqual([image.id for image in self.client.load_less_tagged()], [3])
+
+    @contextmanager
+    def count_statements(self):
+        statements = []
+        engine = self.client.session.bind
+
+        def before_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(engine, "before_cursor_execute", before_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, "before_cursor_execute", before_execute)
+
+    def test_read_page(self):
+        self.client.dump_unclassified(
+            [{"name": f"{i}.png", "path": f"/{i}.png", "tags": ["a", f"tag_{i}"]} for i in range(30)]
+        )
+        for size in (6, 20):
+            # images and their tags
+            with self.count_statements() as statements:
+                images, cursor = self.client.read_page(size)
+            self.assertEqual(len(statements), 2, statements)
+            self.assertEqual(len(images), size)
+            self.assertEqual(set(images[0].tags), {"a", f"tag_{images[0].id - 1}"})
+
+            with self.count_statements() as statements:
+                self.client.read_page(size, cursor=cursor, with_tags=False)
+            self.assertEqual(len(statements), 1, statements)
+
+        self.assertEqual(set(self.client.read_image(1).tags), {"a", "tag_0"})
+
+    def test_set_tags(self):
+        self.client.dump_unclassified(
+            [{"name": f"{i}.png", "path": f"/{i}.png", "tags": ["a"] if i else []} for i in range(4)]
+        )
+        self.assertEqual([image.id for image in self.client.load_less_tagged_images()], [1])
+
+        self.client.set_tags({1: ["b", "c", "b"], 2: ["b"], 3: []})
+        self.assertEqual(set(self.client.read_image(1).tags), {"b", "c"})
+        self.assertEqual(self.client.read_image(2).tags, ("b",))
+        self.assertEqual(
+            {tag.name: tag.usage_count for tag in self.client.get_most_popular_tags()},
+            {"a": 1, "b": 2, "c": 1},
+        )
+        self.assertEqual(
+            [image.id for image in self.client.load_less_tagged_images(after_id=1)], [3]
+        )
+        images, _ = self.client.get_paginated_result(10, tags=["b"])
+        self.assertEqual({image.id for image in images}, {1, 2})
+
+    def test_tree(self):
+        tags = (
+            [["a", "b"]] * 4 + [["a", "c"]] * 3 + [["a"]] * 2 + [["b", "c"]] * 3 + [["d"]] * 2
+        )
+        self.client.dump_unclassified(
+            [{"name": f"{i}.png", "path": f"/{i}.png", "tags": tags[i]} for i in range(len(tags))]
+        )
+        ids = dict(self.client.session.query(Tag.name, Tag.id))
+        names = {id: name for name, id in ids.items()}
+        tree = [
+            ([names[id] for id in path], sorted(images))
+            for path, images in self.client.tree(min_elements=2)
+        ]
+        self.assertEqual(
+            tree,
+            [
+                # d is in 2 images, not more than 2
+                ([], [13, 14]),
+                # a: 9, b: 7, c: 6
+                (["a"], [8, 9]),
+                # the 3 a + c images don't have b
+                (["a", "b"], [1, 2, 3, 4]),
+                (["a", "c"], [5, 6, 7]),
+                # the b + c images, under b because b goes first
+                (["b", "c"], [10, 11, 12]),
+            ],
+        )
+
+class Test_Ingest(unittest.TestCase):
+
+    def setUp(self):
+        engine = build_test_db()
+        self.client = DBClient(engine=engine)
+        self.dest = TemporaryDirectory()
+        self.ingestor = Ingestor(path=TEST_FILES, dest=self.dest.name)
+
+    def tearDown(self):
+        self.ingestor.stop()
+        self.dest.cleanup()
+
+    def test_write(self):
+        images = load_images(TEST_FILES)
+        self.ingestor.write(self.client, images)
+
+        status = self.ingestor.status()
+        self.assertEqual(status["total_ingested"], self.client.count_images())
+        self.assertEqual(status["total_ingested"], len(os.listdir(self.dest.name)))
+        self.assertEqual(status["queue_depth"], 0)
+
+        # already ingested
+        self.ingestor.write(self.client, load_images(TEST_FILES))
+        self.assertEqual(self.ingestor.status()["total_ingested"], status["total_ingested"])
+
+    def test_is_duplicate(self):
+        src = Path(self.dest.name) / "src"
+        os.makedirs(src)
+        # same size and edges, different middle
+        edge = b"a" * 64 * 1024
+        (src / "1.png").write_bytes(edge + b"1" + edge)
+        (src / "2.png").write_bytes(edge + b"2" + edge)
+        (src / "3.png").write_bytes(edge + b"1" + edge)
+
+        images = [{"path": str(src / name), "tags": []} for name in ("1.png", "2.png", "3.png")]
+        self.ingestor.write(self.client, images)
+
+        self.assertEqual(self.ingestor.status()["total_ingested"], 2)
+        self.assertEqual(self.ingestor.status()["duplicates"], 1)
+        hashes = self.client.get_hashes(len(edge) * 2 + 1)
+        self.assertEqual(len(hashes), 2)
+        self.assertEqual(hashes[0][0], hashes[1][0])
+        self.assertNotEqual(hashes[0][1], hashes[1][1])
+
+    def test_hash_tiers(self):
+        src = Path(self.dest.name) / "src"
+        os.makedirs(src)
+        (src / "1.png").write_bytes(b"1" * 10)
+        (src / "copy.png").write_bytes(b"1" * 10)
+        (src / "2.png").write_bytes(b"2" * 20)
+        self.ingestor.write(self.client, [{"path": str(src / "1.png"), "tags": []}])
+
+        images = [{"path": str(src / name), "tags": []} for name in ("copy.png", "2.png")]
+        with unittest.mock.patch("rp_tagger.ingest.dhash", return_value=None) as phash:
+            self.ingestor.write(self.client, images)
+        # the copy matched the size and the edges of 1.png, it was only
+        # compared with the hash of the whole file
+        self.assertEqual([call.args[0] for call in phash.call_args_list], [str(src / "2.png")])
+        self.assertEqual(self.ingestor.status()["duplicates"], 1)
+
+    def test_insert_failure(self):
+        src = Path(self.dest.name) / "src"
+        os.makedirs(src)
+        for name in ("1.png", "2.png"):
+            (src / name).write_bytes(name.encode())
+        images = [{"path": str(src / name), "tags": []} for name in ("1.png", "2.png")]
+
+        for transfer in ("move", "copy"):
+            self.ingestor.transfer = transfer
+            with unittest.mock.patch.object(self.client, "dump_unclassified", side_effect=OSError("full")):
+                with self.assertRaises(OSError):
+                    self.ingestor.write(self.client, images)
+            # no orphans in the library and the moved files are back
+            self.assertEqual(os.listdir(self.dest.name), ["src"])
+            self.assertEqual(sorted(os.listdir(src)), ["1.png", "2.png"])
+            self.assertEqual(self.client.count_images(), 0)
+
+    def test_scan_failure(self):
+        src = Path(self.dest.name) / "src"
+        os.makedirs(src)
+        (src / "1.png").write_bytes(b"data")
+        ingestor = Ingestor(
+            path=src, dest=self.dest.name, manifest_path=Path(self.dest.name) / "manifest.json"
+        )
+        self.addCleanup(ingestor.stop)
+        threading.Thread(target=ingestor._write_loop, daemon=True).start()
+
+        with unittest.mock.patch.object(DBClient, "dump_unclassified", side_effect=OSError("full")):
+            ingestor.scan()
+        self.assertEqual(self.client.count_images(), 0)
+
+        # the manifest didn't keep it, a new scan tries again
+        ingestor = Ingestor(
+            path=src, dest=self.dest.name, manifest_path=Path(self.dest.name) / "manifest.json"
+        )
+        self.assertEqual([image["path"] for image in ingestor.scanner.scan()], [str(src / "1.png")])
+
+    def test_transfer(self):
+        src = Path(self.dest.name) / "src.png"
+        src.write_bytes(b"data")
+        for mode in ("copy", "hardlink", "reflink", "symlink"):
+            dst = Path(self.dest.name) / f"{mode}.png"
+            transfer_file(src, dst, mode)
+            self.assertEqual(dst.read_bytes(), b"data")
+
+        transfer_file(src, Path(self.dest.name) / "moved.png", "move")
+        self.assertFalse(src.exists())
+
+class Test_Scanner(unittest.TestCase):
+
+    def setUp(self):
+        self.root = TemporaryDirectory()
+        self.path = Path(self.root.name) / "images"
+        self.manifest = Path(self.root.name) / "manifest.json"
+        os.makedirs(self.path / "a" / "b")
+        for name in ("a/1.png", "a/b/2.jpg", "3.gif", "a/notes.txt"):
+            (self.path / name).write_bytes(b"data")
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def scan(self):
+        scanner = Scanner(self.path, self.manifest)
+        images = list(scanner.scan())
+        scanner.save()
+        return {img["path"]: img["tags"] for img in images}
+
+    def test_scan(self):
+        images = self.scan()
+        self.assertEqual(images, {img["path"]: img["tags"] for img in load_images(self.path)})
+        self.assertEqual(set(images[str(self.path / "a/b/2.jpg")]), {"a", "b"})
+
+        self.assertEqual(self.scan(), {})
+
+        (self.path / "a" / "b" / "4.webm").write_bytes(b"data")
+        self.assertEqual(list(self.scan()), [str(self.path / "a/b/4.webm")])
+
+class Test_Index(unittest.TestCase):
+
+    def setUp(self):
+        engine = build_test_db()
+        self.client = DBClient(engine=engine, index=TagIndex())
+        self.sql_client = DBClient(engine=engine, index=None)
+        images = load_images(TEST_FILES)
+        for image in images:
+            image["name"] = image["path"].split("/")[-1]
+        self.client.dump_unclassified(images)
+
+    def search(self, client, tags):
+        images, cursor = client.get_paginated_result(100, tags=list(tags))
+        self.assertIsNone(cursor)
+        return [image.id for image in images]
+
+    def test_search(self):
+        for tags in (["g"], ["g", "book"], ["boo"], ["a", "g"], ["sci", "book"]):
+            self.assertEqual(
+                set(self.search(self.client, tags)),
+                set(self.search(self.sql_client, tags)),
+                tags,
+            )
+        self.assertEqual(len(self.search(self.client, ["g", "book"])), 12)
+        # a fresh index sees the same thing
+        fresh = DBClient(engine=self.client.session.bind, index=TagIndex())
+        self.assertEqual(self.search(fresh, ["g", "book"]), self.search(self.client, ["g", "book"]))
+
+    def test_match(self):
+        for name in ("long_hair", "longXhair", "100%", "Éclair", "éclair"):
+            self.client.add_image(f"{name}.png", f"/{name}.png", [name])
+        for term in ("g_h", "%", "0%", "ÉCLAIR", "éclair", "CLAIR", "LONG"):
+            self.assertEqual(
+                set(self.search(self.client, [term])),
+                set(self.search(self.sql_client, [term])),
+                term,
+            )
+        self.assertEqual(len(self.search(self.client, ["g_h"])), 1)
+
+    def test_touch(self):
+        index = self.client.index
+        ids = self.search(self.client, ["g"])
+        version = index.version
+        self.client.touch_image(ids[-1])
+        # the result of the last search is kept
+        self.assertEqual(index.version, version)
+        self.assertEqual(self.search(self.client, ["g"]), [ids[-1]] + ids[:-1])
+        self.assertEqual(self.search(self.client, ["g"]), self.search(self.sql_client, ["g"]))
+
+    def test_update(self):
+        id = self.search(self.client, ["sci"])[0]
+        self.client.update_image(id, tags=["sci", "new"])
+        self.assertEqual(self.search(self.client, ["new"]), [id])
+
+        self.client.touch_image(id)
+        self.client.update_image(id, tags=["g"])
+        self.assertEqual(self.search(self.client, ["g"])[0], id)
+        self.assertEqual(self.search(self.client, ["new"]), [])
+
+    def test_suggest(self):
+        index = self.client.index
+        self.client.dump_unclassified(
+            [
+                {"name": "x.png", "path": "/x.png", "tags": ["red", "hair"]},
+                {"name": "y.png", "path": "/y.png", "tags": ["red", "hair", "eyes"]},
+                {"name": "z.png", "path": "/z.png", "tags": ["red", "eyes"]},
+            ]
+        )
+        # P(red | hair) = 1, P(eyes | hair) = 0.5
+        self.assertEqual(index.suggest(["hair"]), ["red", "eyes"])
+        self.assertEqual(index.suggest(["hair", "eyes"]), ["red"])
+
+        self.client.update_image(self.client.query_image(path="/x.png").id, tags=["hair", "eyes"])
+        self.assertEqual(index.suggest(["hair"]), ["eyes", "red"])
+        self.client.delete_tag("red")
+        self.assertEqual(index.suggest(["hair"]), ["eyes"])
+
+        # the same as counting from scratch
+        fresh = TagIndex()
+        fresh.load(self.client.session)
+        pairs = lambda index: {name: +row for name, row in index.cooccurrences.items() if +row}
+        self.assertEqual(pairs(index), pairs(fresh))
+        self.assertEqual(+index.counts, +fresh.counts)
+
+        # the most popular tags fill the rest
+        suggested = self.client.suggest_tags(["hair"], limit=3)
+        self.assertEqual(suggested[0], "eyes")
+        self.assertEqual(len(suggested), 3)
+        self.assertNotIn("hair", suggested)
+
+class Test_HitBuffer(unittest.TestCase):
+
+    def setUp(self):
+        engine = build_test_db()
+        index = TagIndex()
+        self.buffer = HitBuffer(lambda: DBClient(engine=engine, index=index))
+        self.client = DBClient(engine=engine, index=index, hits=self.buffer)
+        self.client.dump_unclassified(
+            [{"name": f"{i}.png", "path": f"/{i}.png", "tags": ["tag", "other"]} for i in range(3)]
+        )
+
+    def hits(self, model):
+        self.client.session.expire_all()
+        key = model.name if model is Tag else model.id
+        return dict(self.client.session.query(key, model.hits))
+
+    def test_flush(self):
+        for id in (1, 1, 2):
+            self.client.touch_image(id)
+        self.client.get_paginated_result(10, tags=["tag"])
+        self.assertEqual(self.buffer.pending, 4)
+        self.assertEqual(set(self.hits(Image).values()), {0})
+
+        self.buffer.flush()
+        self.assertEqual(self.buffer.pending, 0)
+        self.assertEqual(self.hits(Image), {1: 2, 2: 1, 3: 0})
+        self.assertEqual(self.hits(Tag), {"tag": 1, "other": 0})
+        self.assertEqual(self.client.index.search(["tag"]), [1, 2, 3])
+
+class Test_Migrations(unittest.TestCase):
+
+    # the schema before the first migration
+    BASELINE = (
+        "CREATE TABLE tag (id INTEGER NOT NULL, name VARCHAR NOT NULL, "
+        "hits INTEGER NOT NULL, PRIMARY KEY (id))",
+        "CREATE TABLE image (id INTEGER NOT NULL, name VARCHAR NOT NULL, path VARCHAR NOT NULL, "
+        "hits INTEGER NOT NULL, last_used DATETIME, date_created DATETIME NOT NULL, "
+        "PRIMARY KEY (id), UNIQUE (name))",
+        "CREATE TABLE assoc_tagged_image (image_id INTEGER NOT NULL, tag_id INTEGER NOT NULL, "
+        "FOREIGN KEY(image_id) REFERENCES image (id), FOREIGN KEY(tag_id) REFERENCES tag (id))",
+        "INSERT INTO tag VALUES (1, 'hair', 0), (2, 'book', 0)",
+        "INSERT INTO image VALUES (1, '__0123.png', '/nowhere/__0123.png', 3, NULL, '2022-01-01 00:00:00')",
+        "INSERT INTO assoc_tagged_image VALUES (1, 1), (1, 1), (1, 2)",
+    )
+
+    def test_migrate(self):
+        with TemporaryDirectory() as tmp:
+            engine = create_engine(f"sqlite:///{tmp}/old.sqlite")
+            with engine.begin() as connection:
+                for sql in self.BASELINE:
+                    connection.execute(text(sql))
+
+            self.assertIn("no such column", explain(engine)["popular tags"][0])
+            self.assertEqual(migrate(engine), [version for version, _ in MIGRATIONS])
+            # nothing left to do
+            self.assertEqual(migrate(engine), [])
+
+            client = DBClient(engine=engine, index=None)
+            image = client.query_image(id=1)
+            self.assertEqual(image.content_hash, "0123")
+            self.assertEqual(image.tag_count, 2)
+            self.assertEqual(
+                {tag.name: tag.usage_count for tag in client.get_most_popular_tags()},
+                {"hair": 1, "book": 1},
+            )
+            images, _ = client.get_paginated_result(10, tags=["hai"])
+            self.assertEqual([image.id for image in images], [1])
+            self.assertNotIn("no such column", explain(engine)["popular tags"][0])
+            indexes = {index["name"] for index in inspect(engine).get_indexes("image")}
+            self.assertLessEqual({"ix_image_hits_id", "ix_image_tag_count"}, indexes)
+            indexes = inspect(engine).get_indexes("assoc_tagged_image")
+            self.assertEqual(indexes[0]["column_names"], ["tag_id", "image_id"])
+            engine.dispose()
+
+    def test_fresh(self):
+        with TemporaryDirectory() as tmp:
+            engine = create_engine(f"sqlite:///{tmp}/new.sqlite")
+            self.assertEqual(migrate(engine), [])
+            with engine.connect() as connection:
+                self.assertEqual(get_version(connection), latest_version())
+            engine.dispose()
+
+class Test_Sessions(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = build_test_db()
+        self.client = DBClient(engine=self.engine, index=None)
+        self.client.dump_unclassified(
+            [{"name": f"{i}.png", "path": f"/{i}.png", "tags": ["a"]} for i in range(3)]
+        )
+
+    def test_pragmas(self):
+        with self.engine.connect() as connection:
+            pragma = lambda name: connection.execute(text(f"PRAGMA {name}")).scalar()
+            self.assertEqual(pragma("journal_mode"), "wal")
+            # NORMAL
+            self.assertEqual(pragma("synchronous"), 1)
+            self.assertEqual(pragma("busy_timeout"), settings.SQLITE_PRAGMAS["busy_timeout"])
+
+    def test_session_per_thread(self):
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(self.client.session))
+        thread.start()
+        thread.join()
+        self.assertIsNot(sessions[0], self.client.session)
+
+        session = self.client.session
+        self.client.remove()
+        self.assertIsNot(session, self.client.session)
+
+    def test_read_while_writing(self):
+        counts = []
+        reader = DBClient(engine=self.engine, index=None)
+        with self.client.session.begin():
+            self.client.session.execute(insert(Image).values(name="new.png", path="/new.png"))
+            # the write isn't committed, the reader sees the old data
+            thread = threading.Thread(target=lambda: counts.append(reader.count_images()))
+            thread.start()
+            thread.join(timeout=2)
+        self.assertEqual(counts, [3])
+        self.assertEqual(self.client.count_images(), 4)
+
+def fake_loader(path, width, height):
+    """Decodes nothing. The name says which tag"""
+    if path.endswith("bad.png"):
+        raise OSError("corrupted")
+    score = float(path.strip("/").split(".")[0]) % 2
+    return numpy.full((height, width, 3), [score, 1 - score, 0.0])
+
+def plain_loader(path, width, height):
+    """fake_loader without numpy"""
+    if path.endswith("bad.png"):
+        raise OSError("corrupted")
+    return path, width, height
+
+class Test_DecodePool(unittest.TestCase):
+
+    def test_prefetch(self):
+        images = [SimpleNamespace(path=f"/{i}.png") for i in range(4)] + [SimpleNamespace(path="/bad.png")]
+        for pool in ("process", "thread"):
+            tagger = AutoTagger(batch_size=2, workers=2, prefetch=1, loader=plain_loader, pool=pool)
+            with tagger.decode_pool() as executor:
+                if pool == "process":
+                    # the server has tensorflow loaded by then
+                    self.assertEqual(executor._mp_context.get_start_method(), "spawn")
+                results = list(tagger._prefetch(executor, images, 3, 2))
+
+            self.assertEqual([image for image, _ in results], images)
+            self.assertEqual([result[:2] for _, result in results[:2]], [(("/0.png", 3, 2), None), (("/1.png", 3, 2), None)])
+            self.assertEqual(results[-1][1][:2], (None, "OSError: corrupted"))
+
+# a fake model, the real one isn't needed
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class Test_AutoTagger(unittest.TestCase):
+
+    class Model:
+        input_shape = (None, 2, 2, 3)
+
+        def __init__(self):
+            self.batches = []
+
+        def predict(self, batch, batch_size=None):
+            self.batches.append(len(batch))
+            # the first pixel says which tags
+            return batch[:, 0, 0, :]
+
+    def setUp(self):
+        engine = build_test_db()
+        self.client = DBClient(engine=engine)
+        self.client.dump_unclassified(
+            [{"name": f"{i}.png", "path": f"/{i}.png", "tags": [], "content_hash": str(i)} for i in range(5)]
+            + [{"name": "bad.png", "path": "/bad.png", "tags": []}]
+        )
+        self.model_dir = TemporaryDirectory()
+        self.addCleanup(self.model_dir.cleanup)
+        for name in ("model.h5", "tags.txt"):
+            Path(self.model_dir.name, name).write_text(name)
+        self.model = self.Model()
+        load_model.cache_clear()
+        self.patch = unittest.mock.patch(
+            "rp_tagger.autotag.load_model_and_tags", return_value=(self.model, ["odd", "even", "x"])
+        )
+        self.patch.start()
+        self.addCleanup(self.patch.stop)
+        self.addCleanup(load_model.cache_clear)
+
+    def test_run(self):
+        for workers in (0, 2):
+            self.client.set_tags({image.id: [] for image in self.client.load_images()})
+            self.model.batches = []
+            tagger = AutoTagger(
+                batch_size=2, workers=workers, prefetch=1, loader=fake_loader, cache=False
+            )
+            self.assertEqual(tagger.run(self.client), 5)
+            self.assertEqual(self.model.batches, [2, 2, 1])
+            records = self.client.image_records(self.client.load_images())
+            tags = {image.name: image.tags for image in records}
+            self.assertEqual(tags["1.png"], ("odd",))
+            self.assertEqual(tags["2.png"], ("even",))
+            self.assertEqual(tags["bad.png"], ())
+            self.assertEqual(tagger.status()["skipped"], 1)
+
+    def test_cache(self):
+        tagger = AutoTagger(
+            model_dir=self.model_dir.name, batch_size=2, workers=0, loader=fake_loader
+        )
+        self.assertEqual(tagger.run(self.client), 5)
+        self.assertEqual(self.model.batches, [2, 2, 1])
+
+        # a lower threshold, the model isn't needed
+        self.client.set_tags({image.id: [] for image in self.client.load_images()})
+        tagger.threshold = 0.1
+        self.assertEqual(tagger.run(self.client), 5)
+        self.assertEqual(self.model.batches, [2, 2, 1])
+        self.assertEqual(tagger.status()["cached"], 5)
+
+        # the cache doesn't have the scores under AUTOTAG_CACHE_MIN_SCORE
+        self.client.set_tags({image.id: [] for image in self.client.load_images()})
+        tagger.threshold = 0.0
+        self.assertEqual(tagger.run(self.client), 5)
+        self.assertEqual(self.model.batches, [2, 2, 1, 2, 2, 1])
+        self.assertEqual(tagger.status()["cached"], 0)
+        records = self.client.image_records(self.client.load_images())
+        self.assertEqual(set({image.name: image.tags for image in records}["1.png"]), {"odd", "even", "x"})
+
+        # as many scores as the cache keeps over the threshold, there could be more
+        tagger.threshold = 0.5
+        cache = ScoreCache(self.client, model_fingerprint(self.model_dir.name), top_k=1)
+        cached = []
+        images = self.client.load_images()
+        self.assertEqual(list(tagger._lookup(images, cache, cached)), images)
+        self.assertEqual(cached, [])
+
+        cache = tagger.score_cache(self.client)
+        self.assertEqual(cache.prune(), 0)
+        self.client.session.execute(text("DELETE FROM image WHERE content_hash = '1'"))
+        self.assertEqual(cache.prune(), 1)
+        self.assertEqual(len(cache.get(["0", "1", "2"])), 2)
+
+    def test_encode_scores(self):
+        scores = numpy.array([0.1, 0.9, 0.01, 0.5], dtype=numpy.float32)
+        indexes, values = decode_scores(encode_scores(scores, top_k=2, min_score=0.05))
+        self.assertEqual(list(indexes), [1, 3])
+        numpy.testing.assert_allclose(values, [0.9, 0.5], atol=1e-3)
+
+class Test_AutotagQueue(unittest.TestCase):
+
+    class Tagger(AutoTagger):
+
+        def __init__(self):
+            super().__init__(batch_size=2)
+
+        def tag_images(self, images, client=None):
+            for image in images:
+                self.stats["inference"] += 1.0
+                yield image, [] if image.name == "nothing.png" else ["auto"]
+
+    def setUp(self):
+        engine = build_test_db()
+        self.client = DBClient(engine=engine, index=None)
+        self.client.dump_unclassified(
+            [{"name": f"{i}.png", "path": f"/{i}.png", "tags": ["a"] if i == 2 else []} for i in range(7)]
+            + [{"name": "nothing.png", "path": "/nothing.png", "tags": []},
+               {"name": "x.gif", "path": "/x.gif", "tags": []}]
+        )
+        self.queue = AutotagQueue(self.client)
+
+    def test_work(self):
+        job_id = self.queue.create_job(chunk_size=3)
+        self.assertEqual(self.queue.get_job(job_id).total, 7)
+        self.assertEqual(self.queue.chunk_counts(job_id), {"pending": 3})
+
+        self.queue.start(job_id)
+        # two workers with their own sessions
+        clients = [DBClient(engine=self.client.session.bind, index=None) for _ in range(2)]
+        threads = [
+            threading.Thread(target=work, args=(client, job_id, self.Tagger(), f"w{i}"))
+            for i, client in enumerate(clients)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.queue.close(job_id), "done")
+        progress = self.queue.progress(job_id)
+        self.assertEqual((progress["processed"], progress["tagged"]), (7, 6))
+        self.assertEqual(progress["progress"], 1.0)
+        self.assertEqual([image.name for image in self.client.load_less_tagged_images()], ["nothing.png"])
+        self.assertIsNone(self.queue.active_job())
+
+        stages = self.queue.stage_times(job_id)
+        self.assertEqual((stages["images"], stages["inference"], stages["inference_per_image"]), (7, 7.0, 1.0))
+        self.assertGreater(stages["write"], 0)
+
+    def test_resume_and_cancel(self):
+        job_id = self.queue.create_job(chunk_size=3)
+        self.queue.start(job_id)
+        # the worker died with it
+        chunk = self.queue.claim(job_id, "dead")
+        self.assertEqual(self.queue.chunk_counts(job_id), {"pending": 2, "running": 1})
+
+        self.assertEqual(self.queue.active_job().id, job_id)
+        self.queue.start(job_id)
+        self.assertEqual(self.queue.chunk_counts(job_id), {"pending": 3})
+
+        self.queue.cancel(job_id)
+        work(self.client, job_id, self.Tagger())
+        self.assertEqual(self.queue.chunk_counts(job_id), {"pending": 3})
+        self.assertEqual(self.queue.close(job_id), "cancelled")
+
+class Test_Export(unittest.TestCase):
+
+    def setUp(self):
+        engine = build_test_db()
+        self.client = DBClient(engine=engine, index=None)
+        self.root = TemporaryDirectory()
+        self.src = Path(self.root.name) / "src"
+        self.dest = Path(self.root.name) / "dest"
+        self.manifest = Path(self.root.name) / "manifest.json"
+        os.makedirs(self.src)
+        for i in range(4):
+            (self.src / f"{i}.png").write_bytes(b"data %d" % i)
+        self.client.dump_unclassified(
+            [{"name": f"{i}.png", "path": str(self.src / f"{i}.png"), "tags": ["a", "b"]} for i in range(4)]
+        )
+        self.tags = dict(self.client.session.query(Tag.name, Tag.id))
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def export(self, groups, mode="copy"):
+        exporter = Exporter(dest=self.dest, mode=mode, workers=2, manifest_path=self.manifest)
+        groups = [([self.tags[tag] for tag in path], ids) for path, ids in groups]
+        stats = exporter.export(self.client, groups)
+        del stats["seconds"]
+        return stats
+
+    def files(self):
+        return sorted(
+            str(path.relative_to(self.dest)) for path in self.dest.rglob("*") if path.is_file()
+        )
+
+    def test_export(self):
+        groups = [(["a"], [1, 2]), (["a", "b"], [3]), ([], [4])]
+        self.assertEqual(
+            self.export(groups),
+            {"added": 4, "moved": 0, "removed": 0, "unchanged": 0, "errors": 0},
+        )
+        self.assertEqual(self.files(), ["3.png", "a/0.png", "a/1.png", "a/b/2.png"])
+        self.assertEqual((self.dest / "a" / "b" / "2.png").read_bytes(), b"data 2")
+
+        self.assertEqual(
+            self.export(groups),
+            {"added": 0, "moved": 0, "removed": 0, "unchanged": 4, "errors": 0},
+        )
+
+        # 3 leaves a/b and 4 is gone
+        groups = [(["a"], [1, 2, 3])]
+        self.assertEqual(
+            self.export(groups),
+            {"added": 0, "moved": 1, "removed": 1, "unchanged": 2, "errors": 0},
+        )
+        self.assertEqual(self.files(), ["a/0.png", "a/1.png", "a/2.png"])
+        # the empty folders are removed
+        self.assertFalse((self.dest / "a" / "b").exists())
+
+    def test_mode(self):
+        groups = [(["a"], [1, 2])]
+        self.export(groups)
+        self.assertEqual(
+            self.export(groups, mode="symlink")["added"], 2
+        )
+        self.assertTrue((self.dest / "a" / "0.png").is_symlink())
+        self.assertEqual((self.dest / "a" / "0.png").read_bytes(), b"data 0")
+
+class Test_Jobs(unittest.TestCase):
+
+    def setUp(self):
+        engine = build_test_db()
+        self.client = DBClient(engine=engine, index=None)
+        self.jobs = Jobs(self.client, workers=1)
+        self.release = threading.Event()
+        self.sessions = []
+
+        @self.jobs.task("slow")
+        def slow(job, client, value):
+            self.sessions.append(client.session)
+            job.update(0.5, "waiting")
+            self.release.wait(5)
+            job.check()
+            return value
+
+        @self.jobs.task("fail")
+        def fail(job, client):
+            raise ValueError("broken")
+
+    def tearDown(self):
+        self.release.set()
+        self.jobs.shutdown()
+
+    def test_jobs(self):
+        first = self.jobs.submit("slow", value=1)
+        # one job of each kind
+        self.assertEqual(self.jobs.submit("slow", value=2), first)
+        # only one worker, it waits
+        second = self.jobs.submit("fail")
+        self.assertEqual(self.jobs.get(second)["status"], "pending")
+
+        self.release.set()
+        status = self.jobs.wait(first)
+        self.assertEqual((status["status"], status["result"], status["progress"]), ("done", 1, 1.0))
+        # the job had its own session
+        self.assertIsNot(self.sessions[0], self.client.session)
+
+        status = self.jobs.wait(second)
+        self.assertEqual((status["status"], status["error"]), ("failed", "broken"))
+        self.assertEqual([job["id"] for job in self.jobs.list()], [first, second])
+        with self.assertRaises(KeyError):
+            self.jobs.submit("nothing")
+
+    def test_cancel(self):
+        running = self.jobs.submit("slow", value=1)
+        pending = self.jobs.submit("fail")
+        self.jobs.cancel(pending)
+        self.assertEqual(self.jobs.get(pending)["status"], "cancelled")
+
+        self.jobs.cancel(running)
+        self.release.set()
+        self.assertEqual(self.jobs.wait(running)["status"], "cancelled")
+        self.assertEqual(self.jobs.wait(pending)["status"], "cancelled")
+
+class Test_Media(unittest.TestCase):
+
+    NAME = "__0123abcd.webm"
+
+    def setUp(self):
+        from flask import Flask
+
+        self.root = TemporaryDirectory()
+        self.data = bytes(range(256)) * 4
+        (Path(self.root.name) / self.NAME).write_bytes(self.data)
+        (Path(self.root.name) / "old.png").write_bytes(b"data")
+
+        app = Flask(__name__)
+        self.sendfile = None
+
+        @app.route("/media/<name>")
+        def media(name):
+            return send_media(self.root.name, name, max_age=60, sendfile=self.sendfile, accel_prefix="/_media")
+
+        self.app = app.test_client()
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def test_cache(self):
+        response = self.app.get(f"/media/{self.NAME}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.data)
+        self.assertEqual(response.get_etag(), ("0123abcd", False))
+        self.assertEqual(response.cache_control.max_age, 60)
+        self.assertTrue(response.cache_control.immutable)
+        self.assertFalse(response.cache_control.no_cache)
+
+        # the file isn't needed to answer
+        os.remove(Path(self.root.name) / self.NAME)
+        response = self.app.get(f"/media/{self.NAME}", headers={"If-None-Match": '"0123abcd"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+
+        # files without the hash in the name
+        response = self.app.get("/media/old.png")
+        self.assertEqual(response.data, b"data")
+        self.assertFalse(response.cache_control.immutable)
+        self.assertEqual(self.app.get("/media/nothing.png").status_code, 404)
+
+    def test_range(self):
+        response = self.app.get(f"/media/{self.NAME}", headers={"Range": "bytes=10-19"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, self.data[10:20])
+        self.assertEqual(response.headers["Content-Range"], f"bytes 10-19/{len(self.data)}")
+
+    def test_sendfile(self):
+        self.sendfile = "x-accel-redirect"
+        response = self.app.get(f"/media/{self.NAME}")
+        self.assertEqual(response.headers["X-Accel-Redirect"], f"/_media/{self.NAME}")
+        self.assertEqual(response.data, b"")
+        self.assertTrue(response.cache_control.immutable)
+
+        self.sendfile = "x-sendfile"
+        response = self.app.get(f"/media/{self.NAME}")
+        self.assertEqual(response.headers["X-Sendfile"], os.path.join(self.root.name, self.NAME))
+
+class Test_QueryCache(unittest.TestCase):
+
+    def setUp(self):
+        engine = build_test_db()
+        self.cache = QueryCache(max_entries=2, ttl=10)
+        self.client = DBClient(engine=engine, index=None, cache=self.cache)
+        self.client.dump_unclassified([{"name": "1.png", "path": "/1.png", "tags": ["a"]}])
+
+    def test_lru(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.assertEqual(self.cache.get("a"), 1)
+        # b is the least recently used
+        self.cache.set("c", 3)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("a"), 1)
+
+        with unittest.mock.patch("rp_tagger.cache.time.monotonic", return_value=10 ** 9):
+            self.assertIsNone(self.cache.get("a"))
+        status = self.cache.status()
+        self.assertEqual(
+            (status["hits"], status["misses"], status["evictions"], status["expired"]), (2, 2, 1, 1)
+        )
+        self.assertEqual(status["entries"], 1)
+
+    def test_invalidate(self):
+        popular = lambda: [tag.name for tag in self.client.get_most_popular_tags()]
+        self.assertEqual(self.client.cached("popular", popular), ["a"])
+        self.client.session.execute(text("UPDATE tag SET name = 'b'"))
+        # still cached
+        self.assertEqual(self.client.cached("popular", popular), ["a"])
+
+        generation = self.cache.generation
+        self.client.update_image(1, tags=["c"])
+        self.assertEqual(self.client.cached("popular", popular)[0], "c")
+        self.assertEqual(self.cache.generation, generation + 1)
+
+        # computed before the write, not cached
+        def stale():
+            self.client.delete_tag("b")
+            return "stale"
+
+        self.assertEqual(self.client.cached("stale", stale), "stale")
+        self.assertIsNone(self.cache.get("stale"))
+
+class Test_Backup(unittest.TestCase):
+
+    def setUp(self):
+        engine = build_test_db()
+        self.client = DBClient(engine=engine, index=None)
+        self.client.dump_unclassified(
+            [{"name": f"{i}.png", "path": f"/{i}.png", "tags": ["a", f"t{i % 3}"] if i else []} for i in range(10)]
+        )
+        self.client.update_image(3, tags=["b"])
+        self.client.flush_hits({3: 5}, {})
+        self.root = TemporaryDirectory()
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def export(self):
+        return sorted(
+            (dict(record, tags=sorted(record["tags"])) for record in export_images(self.client, batch_size=3)),
+            key=lambda record: record["name"],
+        )
+
+    def test_roundtrip(self):
+        records = self.export()
+        self.assertEqual(len(records), 10)
+        self.assertEqual(records[0]["tags"], [])
+        self.assertEqual(records[2]["hits"], 5)
+        self.assertEqual(records[2]["tags"], ["b"])
+
+        path = Path(self.root.name) / "library.ndjson.gz"
+        self.assertEqual(write_dump(self.client, path), 10)
+
+        self.client = DBClient(engine=build_test_db(), index=None)
+        self.assertEqual(import_images(self.client, read_dump(path), batch_size=4), (10, 0))
+        self.assertEqual(self.export(), records)
+        self.assertEqual(
+            {tag.name: tag.usage_count for tag in self.client.get_most_popular_tags()},
+            {"a": 8, "b": 1, "t0": 3, "t1": 3, "t2": 2},
+        )
+        # already there
+        self.assertEqual(import_images(self.client, read_dump(path)), (0, 10))
+
+    def test_gzipped(self):
+        lines = list(to_ndjson(export_images(self.client)))
+        self.assertEqual(gzip.decompress(b"".join(gzipped(lines))).decode(), "".join(lines))
+
+class Test_PHash(unittest.TestCase):
+
+    def setUp(self):
+        engine = build_test_db()
+        self.client = DBClient(engine=engine, index=None)
+
+    def test_search(self):
+        import random
+
+        rng = random.Random(0)
+        hashes = {id: rng.getrandbits(64) for id in range(2000)}
+        # near copies
+        for id in range(2000, 2100):
+            hashes[id] = hashes[id - 2000] ^ (1 << rng.randrange(64)) ^ (1 << rng.randrange(64))
+        index = PHashIndex(parts=4)
+        for id, value in hashes.items():
+            # as they are in the DB
+            index.add(id, value - (1 << 64) if value >> 63 else value)
+
+        for value in list(hashes.values())[::50]:
+            for max_distance in (0, 3, 6, 9):
+                expected = sorted(
+                    (bin(value ^ other).count("1"), id)
+                    for id, other in hashes.items()
+                    if bin(value ^ other).count("1") <= max_distance
+                )
+                self.assertEqual(index.search(value, max_distance), expected)
+
+        index.remove(2000)
+        self.assertEqual(index.search(hashes[0], 0), [(0, 0)])
+        self.assertEqual(len(index.clusters(2)), 99)
+
+    def test_find_duplicates(self):
+        self.client.dump_unclassified(
+            [{"name": f"{i}.png", "path": f"/{i}.png", "tags": []} for i in range(5)]
+        )
+        self.assertEqual(len(self.client.missing_phashes()), 5)
+        self.client.set_phashes({1: 0b1111, 2: 0b0111, 3: -1, 4: -2})
+        self.assertEqual(self.client.missing_phashes(), [(5, "/4.png")])
+        self.assertEqual(
+            find_duplicates(self.client, 1),
+            [[(1, "/0.png"), (2, "/1.png")], [(3, "/2.png"), (4, "/3.png")]],
+        )
+        # not tried again
+        self.client.set_phashes({}, failed=[5])
+        self.assertEqual(self.client.missing_phashes(), [])
+
+    @unittest.skipIf(PILImage is None, "Pillow is not installed")
+    def test_hash_missing(self):
+        with TemporaryDirectory() as tmp:
+            PILImage.linear_gradient("L").save(f"{tmp}/a.png")
+            Path(tmp, "b.png").write_bytes(b"not an image")
+            self.client.dump_unclassified(
+                [{"name": name, "path": f"{tmp}/{name}", "tags": []} for name in ("a.png", "b.png")]
+            )
+            with self.assertLogs("user_info.phash", "WARNING") as logs:
+                self.assertEqual(hash_missing(self.client, workers=1), 1)
+            self.assertEqual(len(logs.output), 1)
+            self.assertEqual(self.client.missing_phashes(), [])
+            self.assertEqual(hash_missing(self.client, workers=1), 0)
+
+    @unittest.skipIf(PILImage is None, "Pillow is not installed")
+    def test_dhash(self):
+        with TemporaryDirectory() as tmp:
+            gradient = PILImage.linear_gradient("L").resize((300, 200))
+            gradient.save(f"{tmp}/a.png")
+            gradient.resize((150, 100)).save(f"{tmp}/b.jpg", quality=70)
+            gradient.rotate(90).save(f"{tmp}/c.png")
+            a, b, c = (dhash(f"{tmp}/{name}") for name in ("a.png", "b.jpg", "c.png"))
+        index = PHashIndex()
+        index.add(1, a)
+        self.assertEqual([id for _, id in index.search(b, 4)], [1])
+        self.assertEqual(index.search(c, 4), [])
+        self.assertIsNone(dhash(f"{tmp}/nothing.png"))
 
 def main_suite() -> unittest.TestSuite:
     s = unittest.TestSuite()
     load_from = unittest.defaultTestLoader.loadTestsFromTestCase
     s.addTests(load_from(Test_API))
+    s.addTests(load_from(Test_Ingest))
+    s.addTests(load_from(Test_Scanner))
+    s.addTests(load_from(Test_Index))
+    s.addTests(load_from(Test_PHash))
+    s.addTests(load_from(Test_HitBuffer))
+    s.addTests(load_from(Test_QueryCache))
+    s.addTests(load_from(Test_Backup))
+    s.addTests(load_from(Test_Migrations))
+    s.addTests(load_from(Test_Sessions))
+    s.addTests(load_from(Test_DecodePool))
+    s.addTests(load_from(Test_AutoTagger))
+    s.addTests(load_from(Test_AutotagQueue))
+    s.addTests(load_from(Test_Export))
+    s.addTests(load_from(Test_Jobs))
+    s.addTests(load_from(Test_Media))
 
     return s
 